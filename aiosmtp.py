@@ -0,0 +1,401 @@
+from smtplib import (SMTPAuthenticationError, SMTPConnectError, SMTPDataError, SMTPException,
+                     SMTPNotSupportedError, SMTPRecipientsRefused, SMTPResponseException, SMTPSenderRefused,
+                     SMTPServerDisconnected)
+from email.utils import getaddresses
+import asyncio
+import base64
+import socket
+import ssl
+import time
+
+from journal import QUEUED, SENT, FAILED
+from metrics import METRICS
+from retry import Backoff, is_closing, is_refused, is_transient
+from smtpdata import CRLF, domains, flatten, prepare_data, recipients
+
+class AsyncSMTP:
+    """an SMTP client running on asyncio, every command waits for the server without blocking
+    the event loop so a single thread can keep many sessions open at the same time"""
+
+    def __init__(self, host, port, timeout=60, local_hostname=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.local_hostname = local_hostname or socket.getfqdn()
+        self.reader = None
+        self.writer = None
+        self.extensions = {}
+
+    async def connect(self):
+        """opens the connection and reads the greeting of the server"""
+
+        with METRICS.time('smtp_command_seconds', command='connect'):
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                              self.timeout)
+            code, msg = await self.getreply()
+        if code != 220:
+            self.close()
+            raise SMTPConnectError(code, msg)
+        return code, msg
+
+    async def getreply(self):
+        """reads a complete, possibly multiline, reply and returns its code and its text"""
+
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise SMTPServerDisconnected("timed out waiting for the server") from None
+            if not line:
+                self.close()
+                raise SMTPServerDisconnected("connection unexpectedly closed")
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def command(self, line):
+        """sends one command and returns the reply of the server"""
+
+        if self.writer is None:
+            raise SMTPServerDisconnected("please run connect() first")
+        self.writer.write(line.encode('ascii') + CRLF)
+        await self.writer.drain()
+        return await self.getreply()
+
+    async def ehlo(self):
+        """greets the server and remembers the extensions it supports"""
+
+        code, msg = await self.command(f"EHLO {self.local_hostname}")
+        if code != 250:
+            raise SMTPResponseException(code, msg)
+        self.extensions = {}
+        for line in msg.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params.strip()
+        return code, msg
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    async def starttls(self, context=None):
+        """upgrades the connection to TLS and greets the server again as asked by RFC 3207"""
+
+        if not self.has_extn('starttls'):
+            raise SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        with METRICS.time('smtp_command_seconds', command='starttls'):
+            code, msg = await self.command("STARTTLS")
+            if code != 220:
+                raise SMTPResponseException(code, msg)
+            context = context or ssl.create_default_context()
+            await self.writer.start_tls(context, server_hostname=self.host)
+        await self.ehlo()
+        return code, msg
+
+    async def login(self, user, password):
+        """logs in with AUTH PLAIN or AUTH LOGIN, whichever the server supports"""
+
+        with METRICS.time('smtp_command_seconds', command='auth'):
+            return await self._login(user, password)
+
+    async def _login(self, user, password):
+        mechanisms = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms:
+            token = base64.b64encode(f"\0{user}\0{password}".encode()).decode('ascii')
+            code, msg = await self.command(f"AUTH PLAIN {token}")
+        elif 'LOGIN' in mechanisms:
+            code, msg = await self.command("AUTH LOGIN")
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(user.encode()).decode('ascii'))
+            if code == 334:
+                code, msg = await self.command(base64.b64encode(password.encode()).decode('ascii'))
+        else:
+            raise SMTPNotSupportedError("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise SMTPAuthenticationError(code, msg)
+        return code, msg
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """sends the bytes 'msg' to all the addresses of 'to_addrs', returns the refused recipients
+        like smtplib and raises SMTPRecipientsRefused if none of them was accepted, when the server
+        advertises PIPELINING the MAIL, RCPT and DATA commands are sent together"""
+
+        refused = await self._open_data(from_addr, to_addrs, len(msg))
+        start = time.perf_counter()
+        self.writer.write(prepare_data(msg))
+        return await self._end_data(refused, start)
+
+    async def send_wire(self, wire):
+        """sends a WireMessage, its buffers are handed to the transport without being joined"""
+
+        refused = await self._open_data(wire.sender, wire.recipients, len(wire))
+        start = time.perf_counter()
+        await self.write_buffers(wire.data())
+        return await self._end_data(refused, start)
+
+    async def write_buffers(self, buffers, chunk_size=1 << 18):
+        """hands the 'buffers' to the transport, the ones larger than 'chunk_size' (a memory mapped joint file)
+        by slices of a view waiting for each slice to be sent so that the transport never copies them whole"""
+
+        small = []
+        for buffer in buffers:
+            if len(buffer) <= chunk_size:
+                small.append(buffer)
+                continue
+            self.writer.writelines(small)
+            small = []
+            view = memoryview(buffer)
+            for start in range(0, len(view), chunk_size):
+                self.writer.write(view[start:start + chunk_size])
+                await self.writer.drain()
+        self.writer.writelines(small)
+
+    async def _open_data(self, from_addr, to_addrs, size):
+        """sends the envelope and returns the refused recipients once the server is ready to receive the data"""
+
+        mail = f"MAIL FROM:<{from_addr}>"
+        if self.has_extn('size'):
+            mail += f" SIZE={size}"
+        if self.has_extn('pipelining'):
+            code, resp, refused, data_code, data_resp = await self._pipelined_envelope(mail, to_addrs)
+        else:
+            code, resp, refused, data_code, data_resp = await self._envelope(mail, to_addrs)
+        if code != 250:
+            await self._abort(data_code)
+            raise SMTPSenderRefused(code, resp, from_addr)
+        if len(refused) == len(to_addrs):
+            await self._abort(data_code)
+            raise SMTPRecipientsRefused(refused)
+        if data_code != 354:
+            await self._abort(data_code)
+            raise SMTPDataError(data_code, data_resp)
+        return refused
+
+    async def _end_data(self, refused, start):
+        await self.writer.drain()
+        code, resp = await self.getreply()
+        METRICS.observe('smtp_command_seconds', time.perf_counter() - start, command='data')
+        if code != 250:
+            raise SMTPDataError(code, resp)
+        return refused
+
+    async def _envelope(self, mail, to_addrs):
+        """sends the envelope one command at a time, DATA is only sent if it can succeed"""
+
+        code, resp = await self._timed('mail', mail)
+        if code != 250:
+            return code, resp, {}, None, None
+        refused = {}
+        for address in to_addrs:
+            reply = await self._timed('rcpt', f"RCPT TO:<{address}>")
+            if reply[0] not in (250, 251):
+                refused[address] = reply
+        if len(refused) == len(to_addrs):
+            return code, resp, refused, None, None
+        return (code, resp, refused, *await self._timed('data', "DATA"))
+
+    async def _timed(self, name, line):
+        with METRICS.time('smtp_command_seconds', command=name):
+            return await self.command(line)
+
+    async def _pipelined_envelope(self, mail, to_addrs):
+        """sends the whole envelope in one write and reads all the replies"""
+
+        commands = [mail] + [f"RCPT TO:<{address}>" for address in to_addrs] + ["DATA"]
+        start = time.perf_counter()
+        self.writer.write(''.join(command + '\r\n' for command in commands).encode('ascii'))
+        await self.writer.drain()
+        replies = []
+        for name in ['mail'] + ['rcpt'] * len(to_addrs) + ['data']:
+            replies.append(await self.getreply())
+            METRICS.observe('smtp_command_seconds', time.perf_counter() - start, command=name)
+        refused = {address: reply for address, reply in zip(to_addrs, replies[1:-1]) if reply[0] not in (250, 251)}
+        return (*replies[0], refused, *replies[-1])
+
+    async def _abort(self, data_code):
+        """cancels a transaction, if the server still accepted DATA an empty message is ended first"""
+
+        if data_code == 354:
+            self.writer.write(b'.' + CRLF)
+            await self.getreply()
+        await self.rset()
+
+    async def send_message(self, msg):
+        """sends an EmailMessage to the addresses of its To, Cc and Bcc headers"""
+
+        from_addr = getaddresses([msg['Sender'] or msg['From']])[0][1]
+        to_addrs = recipients(msg)
+        return await self.sendmail(from_addr, to_addrs, flatten(msg))
+
+    async def rset(self):
+        try:
+            return await self.command("RSET")
+        except SMTPServerDisconnected:
+            return None
+
+    async def noop(self):
+        return await self.command("NOOP")
+
+    async def quit(self):
+        try:
+            return await self.command("QUIT")
+        except (SMTPException, OSError):
+            return None
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def open_session(host, port, user, password, use_tls=True, ssl_context=None):
+    """connects to the server, secures the connection with STARTTLS and logs in"""
+
+    smtp = AsyncSMTP(host, port)
+    await smtp.connect()
+    try:
+        await smtp.ehlo()
+        if use_tls:
+            await smtp.starttls(ssl_context)
+        if user is not None:
+            await smtp.login(user, password)
+    except BaseException:
+        smtp.close()
+        raise
+    return smtp
+
+class AsyncManagedConnection:
+    """the asyncio twin of sender.ManagedConnection: opened when first needed, probed with NOOP after
+    'noop_after' idle seconds, opened again before the 'max_messages' per session allowed by the provider
+    and after the server dropped it"""
+
+    def __init__(self, connect, max_messages=None, noop_after=30):
+        self.connect = connect
+        self.max_messages = max_messages
+        self.noop_after = noop_after
+        self.smtp = None
+        self.messages = 0
+        self.last_used = 0
+
+    async def ensure(self):
+        if self.smtp is not None and self.max_messages and self.messages >= self.max_messages:
+            METRICS.inc('smtp_reconnects_total', reason='session_limit')
+            await self.reset()
+        elif self.smtp is not None and time.monotonic() - self.last_used > self.noop_after:
+            try:
+                with METRICS.time('smtp_command_seconds', command='noop'):
+                    code, _ = await self.smtp.noop()
+            except (SMTPException, OSError):
+                code = None
+            if code != 250:
+                METRICS.inc('smtp_reconnects_total', reason='noop')
+                await self.reset()
+        if self.smtp is None:
+            self.smtp = await self.connect()
+            self.messages = 0
+
+    async def send_wire(self, wire):
+        await self.ensure()
+        reused = self.messages > 0
+        try:
+            refused = await self.smtp.send_wire(wire)
+        except (SMTPException, OSError) as e:
+            if is_closing(e) or isinstance(e, OSError):
+                await self.reset()
+                if reused and isinstance(e, SMTPServerDisconnected):
+                    METRICS.inc('smtp_reconnects_total', reason='dropped')
+                    return await self.send_wire(wire)
+            raise
+        finally:
+            self.last_used = time.monotonic()
+        self.messages += 1
+        return refused
+
+    async def reset(self):
+        if self.smtp is not None:
+            await self.smtp.quit()
+        self.smtp = None
+        self.messages = 0
+
+async def send_all_async(emails, host, port, user, password, connections=1, limiter=None, use_tls=True,
+                         ssl_context=None, journal=None, max_messages=None, noop_after=30, backoff=None):
+    """sends all the WireMessages 'emails', given with the identity of their line, over 'connections' concurrent SMTP
+    sessions of the event loop as fast as 'limiter' allows, the Emails are taken from the iterable in a worker
+    thread so building them doesn't block the sessions, the state of every line is recorded in the 'journal'
+    if there is one, transient failures are retried after an exponential 'backoff', a line whose Email is
+    refused fails alone and the sending stops at the first other error, returns the number of Emails sent"""
+
+    loop = asyncio.get_running_loop()
+    backoff = backoff or Backoff()
+    queue = asyncio.Queue(maxsize=connections * 2)
+    iterator = iter(emails)
+    done = object()
+    sent = 0
+
+    async def produce():
+        while (job := await loop.run_in_executor(None, next, iterator, done)) is not done:
+            if journal is not None:
+                journal.record(job[0], QUEUED)
+            await queue.put(job)
+        for _ in range(connections):
+            await queue.put(done)
+
+    async def connect():
+        return await open_session(host, port, user, password, use_tls, ssl_context)
+
+    async def send(connection, wire):
+        attempt = 0
+        while True:
+            try:
+                return await connection.send_wire(wire)
+            except (SMTPException, OSError) as e:
+                if not is_transient(e) or attempt >= backoff.retries:
+                    raise
+                METRICS.inc('smtp_retries_total')
+                await asyncio.sleep(backoff.delay(attempt))
+                attempt += 1
+
+    async def session():
+        nonlocal sent
+        connection = AsyncManagedConnection(connect, max_messages, noop_after)
+        try:
+            while (job := await queue.get()) is not done:
+                id, msg = job
+                if limiter is not None:
+                    await limiter.wait_async(domains(msg.recipients))
+                try:
+                    await send(connection, msg)
+                except BaseException as e:
+                    METRICS.inc('emails_failed_total')
+                    if journal is not None:
+                        journal.record(id, FAILED, e)
+                    if not is_refused(e):
+                        raise
+                    print(f"the Email of the line {id} was refused", e, sep='\n')
+                    continue
+                METRICS.inc('emails_sent_total')
+                if journal is not None:
+                    journal.record(id, SENT)
+                sent += 1
+                print()
+                print(f"{sent} Emails sent")
+        finally:
+            await connection.reset()
+
+    tasks = [loop.create_task(produce())] + [loop.create_task(session()) for _ in range(connections)]
+    try:
+        await asyncio.gather(*tasks)
+    except Exception as e:
+        print("an unexpected error happened", e, sep='\n')
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return sent
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import hashlib
+import mimetypes
+import os
+
+from message import ATTACHMENTS, SharedPart, encode_file
+from metrics import METRICS
+
+def guess_type(name):
+    """returns the maintype and the subtype of a joint file given its name, application/octet-stream when
+    its extension is unknown"""
+
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    return tuple(mimetype.split('/', 1))
+
+def file_names(email_filled):
+    """returns the files listed, separated by ';', in the Attachments part of a filled template"""
+
+    return [name.strip() for name in email_filled.get(ATTACHMENTS, '').split(';') if name.strip()]
+
+class AttachmentStore:
+    """the joint files of a campaign encoded for its Emails, in the folder 'cache' from which they are memory
+    mapped when there is one (see encode_file) and in memory otherwise, a file is found by its content so
+    that the same file named by thousands of lines, or under two paths, is only read and encoded once
+
+    the 'shared' files of the config, given as (path, name), are attached to every Email and kept for the
+    whole campaign, the ones named by the Attachments part of a line are encoded when an Email first needs
+    them and forgotten, the least recently used first, once they take more than 'budget' bytes, the relative
+    paths are in the folder 'directory' and the files of the lines can't be outside of it"""
+
+    def __init__(self, directory, shared=(), cache=None, budget=256 << 20):
+        self.directory = directory
+        self.cache = cache
+        self.budget = budget
+        self.digests = {}
+        self.pinned = {}
+        self.parts = OrderedDict()
+        self.size = 0
+        self.shared = [self.get(path, name, pin=True) for path, name in shared]
+
+    def attachments(self, email_filled):
+        """returns the parts to attach to the Email of a filled template, the shared ones and then the ones
+        of its Attachments part, named like in the csv even when the file is a symlink"""
+
+        names = file_names(email_filled)
+        return self.shared + [self.get(self.resolve(name), os.path.basename(name)) for name in names]
+
+    def resolve(self, name):
+        """returns the real path of the file 'name' given by a line of the csv, which can't be trusted: it must
+        stay inside 'directory', absolute paths, '..' and symlinks leading out of it raise a ValueError"""
+
+        root = os.path.realpath(self.directory)
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.isabs(name) or os.path.commonpath([root, path]) != root:
+            raise ValueError(f"the joint file {name} is outside of {self.directory}")
+        return path
+
+    def check(self, names):
+        """raises a ValueError listing all the files of 'names', given by the lines of the csv, that are outside
+        of 'directory' or can't be read, so that a campaign stops before its first Email and not in the middle"""
+
+        problems = []
+        for name in sorted(set(names)):
+            try:
+                path = self.resolve(name)
+            except ValueError as error:
+                problems.append(str(error))
+                continue
+            if not os.path.isfile(path) or not os.access(path, os.R_OK):
+                problems.append(f"the joint file {name} can't be read")
+        if problems:
+            raise ValueError('\n'.join(problems))
+
+    def get(self, path, name=None, pin=False):
+        """returns the encoded part of the file 'path' attached as 'name' (its own name by default), it is
+        never forgotten if 'pin'"""
+
+        path = os.path.join(self.directory, path)
+        name = name or os.path.basename(path)
+        maintype, subtype = guess_type(name)
+        key = (self.digest(path), name, maintype, subtype)
+        part = self.pinned.get(key) or self.parts.get(key)
+        if part is not None:
+            if key in self.parts:
+                self.parts.move_to_end(key)
+            METRICS.inc('attachment_hits_total')
+            return part
+        if self.cache is not None:
+            part = encode_file(path, self.cache, name, maintype, subtype)
+        else:
+            with open(path, 'rb') as file:
+                part = SharedPart(file.read(), name, maintype, subtype)
+        METRICS.inc('attachments_encoded_total')
+        if pin:
+            self.pinned[key] = part
+            return part
+        self.parts[key] = part
+        self.size += len(part.wire)
+        while self.size > self.budget and len(self.parts) > 1:
+            _, evicted = self.parts.popitem(last=False)
+            self.size -= len(evicted.wire)
+            METRICS.inc('attachments_evicted_total')
+        return part
+
+    def digest(self, path, chunk_size=1 << 20):
+        """returns the sha256 of the content of the file 'path', it is only read again once it changed"""
+
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.digests:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(chunk_size), b''):
+                    digest.update(chunk)
+            self.digests[key] = digest.hexdigest()
+        return self.digests[key]
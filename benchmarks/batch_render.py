@@ -0,0 +1,56 @@
+"""compares the rows per second of filling a template line by line against filling it over whole chunks
+of lines, with the pure python joins and with pyarrow when it is installed
+
+run it from the root of the project with, for example: python -m benchmarks.batch_render --rows 100000"""
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import argparse
+import time
+
+from benchmarks.data import write_csv, write_template
+from rows import read_chunks
+from template import parse_template
+from template import load_pyarrow
+
+BATCH_SIZES = [16, 64, 256, 1024]
+
+def rows_per_second(render, chunks):
+    """returns the rows per second of 'render' called on every chunk, the best of three runs"""
+
+    count = sum(len(chunk) for chunk in chunks)
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for chunk in chunks:
+            render(chunk)
+        best = min(best, time.perf_counter() - start)
+    return count / best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000, help="number of lines of the csv")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        csv_path = Path(directory) / 'data.csv'
+        template_path = Path(directory) / 'mail.txt'
+        write_csv(csv_path, args.rows)
+        write_template(template_path)
+        template = parse_template(template_path)
+        columns = sorted(template.variables)
+        rows = [row for chunk in read_chunks(csv_path, columns) for _, row in chunk]
+
+    per_row = rows_per_second(lambda chunk: [template.render(row) for row in chunk], [rows])
+    print(f"{args.rows} rows, pyarrow {'installed' if load_pyarrow() is not None else 'not installed'}")
+    print(f"{'mode':<8} {'batch':>6} {'rows/s':>12} {'speedup':>8}")
+    print(f"{'row':<8} {1:>6} {per_row:>12.0f} {1:>8.2f}")
+    engines = [('python', False)] + ([('pyarrow', True)] if load_pyarrow() is not None else [])
+    for name, arrow in engines:
+        for size in BATCH_SIZES:
+            chunks = [rows[start:start + size] for start in range(0, len(rows), size)]
+            rate = rows_per_second(lambda chunk: template.render_rows(chunk, arrow), chunks)
+            print(f"{name:<8} {size:>6} {rate:>12.0f} {rate / per_row:>8.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""synthetic campaigns for the benchmarks: contact lists of any size and a template using them"""
+
+import csv
+import random
+
+FIRST_NAMES = ['John', 'Jane', 'Marie', 'Pierre', 'Lucie', 'Hugo', 'Emma', 'Louis', 'Chloé', 'Jules']
+LAST_NAMES = ['Doe', 'Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy']
+COMPANIES = ['ACME', 'Initech', 'Globex', 'Umbrella', 'Hooli', 'Vandelay', 'Stark', 'Wayne', 'Tyrell', 'Cyberdyne']
+CIVILITIES = ['Mr', 'Mrs', '']
+
+TEMPLATE = '''\
+# synthetic template of the benchmarks
+<Expressions> Politesse; " Monsieur {lastName}" if "{Civility}" == "Mr" else " Madame {lastName}" if ("{Civility}" == "Mrs") else ""
+<From> John Doe <john.doe@example.com>
+<To> {Email}
+<Cc> Sponsoring <sponsoring@example.com>
+<Subject> My cool event 2030 for {Company}
+<Body>
+Bonjour{Politesse},
+bla bla bla nous serions ravis de compter {Company} parmi nos partenaires bla bla bla
+bla bla bla {firstName}, vous trouverez notre dossier en pièce jointe bla bla bla
+merci et à bientôt
+'''
+
+def write_csv(path, rows, extra_columns=0, seed=0):
+    """writes a contact list of 'rows' lines with the columns used by TEMPLATE and 'extra_columns'
+    columns that no template uses, like in real exports"""
+
+    rng = random.Random(seed)
+    extra = [f'extra{i}' for i in range(extra_columns)]
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Email', 'Civility', 'firstName', 'lastName', 'Company', 'sent'] + extra)
+        for i in range(rows):
+            first = rng.choice(FIRST_NAMES)
+            last = rng.choice(LAST_NAMES)
+            company = rng.choice(COMPANIES)
+            address = f'{first}.{last}.{i}@{company}.example.com'.lower().encode('ascii', 'ignore').decode()
+            writer.writerow([address, rng.choice(CIVILITIES),
+                             first, last, company, ''] + [f'value {i}' for i in range(extra_columns)])
+
+def write_template(path):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(TEMPLATE)
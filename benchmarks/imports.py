@@ -0,0 +1,34 @@
+"""measures how long importing each module of the project takes in a fresh interpreter, what the
+interpreter costs on its own is subtracted, and lists the heavy modules that the import pulls in
+
+run it from the root of the project with: python -m benchmarks.imports"""
+
+import subprocess
+import sys
+
+MODULES = ['template', 'rows', 'cache', 'ratelimit', 'journal', 'message', 'sender', 'aiosmtp', 'main']
+HEAVY = ['yaml', 'email.message', 'smtplib', 'ssl', 'asyncio', 'sqlite3', 'pyarrow']
+RUNS = 10
+
+def import_time(statement):
+    """returns the best time in seconds of 'statement' over RUNS fresh interpreters and the HEAVY modules
+    it imported"""
+
+    code = (f"import sys, time\nstart = time.perf_counter()\n{statement}\n"
+            f"print(time.perf_counter() - start)\nprint(' '.join(m for m in {HEAVY!r} if m in sys.modules))")
+    best, heavy = None, ''
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        elapsed, _, heavy = output.partition('\n')
+        best = float(elapsed) if best is None else min(best, float(elapsed))
+    return best, heavy.strip()
+
+def main():
+    baseline, _ = import_time('pass')
+    print(f"{'module':>10} {'import ms':>10}  heavy modules imported")
+    for module in MODULES:
+        elapsed, heavy = import_time(f'import {module}')
+        print(f"{module:>10} {(elapsed - baseline) * 1000:>10.1f}  {heavy or '-'}")
+
+if __name__ == '__main__':
+    main()
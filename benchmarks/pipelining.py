@@ -0,0 +1,59 @@
+"""measures how many Emails per second are sent to a local SMTP sink with a simulated round trip time,
+with and without ESMTP PIPELINING, for the blocking and the asyncio clients
+
+run it from the root of the project with: python -m benchmarks.pipelining"""
+
+from email.message import EmailMessage
+from smtplib import SMTP
+import asyncio
+import time
+
+from aiosmtp import AsyncSMTP
+from sender import PipeliningSMTP
+from smtp_sink import SMTPSink
+
+MESSAGES = 100
+RECIPIENTS = 3
+LATENCY = 0.005
+
+def make_message():
+    msg = EmailMessage()
+    msg['From'] = 'john.doe@example.com'
+    msg['To'] = ', '.join(f'contact{i}@example.com' for i in range(RECIPIENTS))
+    msg['Subject'] = 'My cool event 2030'
+    msg.set_content('bla bla bla\n' * 50)
+    return msg
+
+def blocking(client, pipelining):
+    msg = make_message()
+    extensions = ['PIPELINING'] if pipelining else []
+    with SMTPSink(latency=LATENCY, extensions=extensions) as sink:
+        with client('127.0.0.1', sink.port) as smtp:
+            start = time.perf_counter()
+            for _ in range(MESSAGES):
+                smtp.send_message(msg)
+            return MESSAGES / (time.perf_counter() - start)
+
+async def asynchronous(pipelining):
+    msg = make_message()
+    extensions = ['PIPELINING'] if pipelining else []
+    async with SMTPSink(latency=LATENCY, extensions=extensions) as sink:
+        smtp = AsyncSMTP('127.0.0.1', sink.port)
+        await smtp.connect()
+        await smtp.ehlo()
+        start = time.perf_counter()
+        for _ in range(MESSAGES):
+            await smtp.send_message(msg)
+        elapsed = time.perf_counter() - start
+        await smtp.quit()
+        return MESSAGES / elapsed
+
+def main():
+    print(f"{MESSAGES} Emails to {RECIPIENTS} recipients, {LATENCY * 1000:.0f} ms per round trip")
+    print(f"{'smtplib':<32} {blocking(SMTP, False):>8.1f} Emails/s")
+    print(f"{'PipeliningSMTP':<32} {blocking(PipeliningSMTP, True):>8.1f} Emails/s")
+    print(f"{'AsyncSMTP':<32} {asyncio.run(asynchronous(False)):>8.1f} Emails/s")
+    print(f"{'AsyncSMTP with PIPELINING':<32} {asyncio.run(asynchronous(True)):>8.1f} Emails/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""compares the per row cost of rendering a template with the compiled template against the
+previous regex + format_map rendering, for templates of growing length
+
+run it from the root of the project with: python -m benchmarks.render"""
+
+from timeit import repeat
+import re
+
+from template import CompiledString
+
+ROWS = 2000
+SIZES = [1, 10, 100]
+
+def list_variables(string):
+    regex = r'\{([^{}]*)\}'
+    return set(re.findall(regex, string))
+
+def fill_variables(string, variables):
+    used_vars = list_variables(string)
+    vars = {key: value for key, value in variables.items() if key in used_vars}
+    return string.format_map(vars)
+
+def make_body(paragraphs):
+    """returns a body with 'paragraphs' paragraphs each containing a few placeholders"""
+
+    paragraph = "Bonjour {firstName} {lastName}, bla bla bla merci à {Company} bla bla bla\n"
+    return paragraph * paragraphs
+
+def best_per_row(statement):
+    """returns the best time in microseconds to run 'statement' once per row"""
+
+    return min(repeat(statement, number=ROWS, repeat=5)) / ROWS * 1e6
+
+def main():
+    row = {'firstName': 'John', 'lastName': 'Doe', 'Company': 'ACME', 'Email': 'john@doe.com'}
+    print(f"{'paragraphs':>10} {'chars':>8} {'compile us':>11} {'regex us/row':>13} {'compiled us/row':>16}")
+    for size in SIZES:
+        body = make_body(size)
+        compile_time = min(repeat(lambda: CompiledString(body), number=100, repeat=5)) / 100 * 1e6
+        compiled = CompiledString(body)
+        assert compiled.render(row) == fill_variables(body, row)
+        regex = best_per_row(lambda: fill_variables(body, row))
+        fast = best_per_row(lambda: compiled.render(row))
+        print(f"{size:>10} {len(body):>8} {compile_time:>11.1f} {regex:>13.2f} {fast:>16.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""benchmark of every stage of a campaign on synthetic data: parsing the template, loading it from the
+parse cache in a new process, reading the csv, rendering the placeholders, building the html body,
+building the Emails and sending them to a local SMTP sink with a simulated latency, it reports the
+throughput, the p50 and p99 latency of one operation and the peak memory after each stage
+
+run it from the root of the project with, for example:
+    python -m benchmarks.run --rows 100000 --attachment-kb 5000 --latency 0.005"""
+
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictReader
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import argparse
+import os
+import random
+import resource
+import time
+
+from attachments import AttachmentStore
+from benchmarks.data import write_csv, write_template
+from cache import ParseCache
+from message import build_wire, html_body, make_boundary
+from parallel import build_mails_parallel
+from rows import read_rows as rows_of_csv
+from sender import SMTPPool
+from smtp_sink import SMTPSink
+from template import parse_template
+
+SIGNATURE = '<p><b>John Doe</b><br>Event manager</p>'
+
+class Stage:
+    """measures the duration of every operation of a stage, a random sample of them is kept to compute
+    the percentiles so that the memory used doesn't depend on the number of operations"""
+
+    def __init__(self, name, sample_size=10_000):
+        self.name = name
+        self.sample_size = sample_size
+        self.sample = []
+        self.count = 0
+        self.start = None
+        self.elapsed = 0
+        self.rng = random.Random(0)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+    def time(self, function, *args):
+        """runs 'function' and records its duration"""
+
+        start = time.perf_counter_ns()
+        result = function(*args)
+        self.record(time.perf_counter_ns() - start)
+        return result
+
+    def record(self, duration):
+        self.count += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(duration)
+        else:
+            index = self.rng.randrange(self.count)
+            if index < self.sample_size:
+                self.sample[index] = duration
+
+    def percentile(self, p):
+        ordered = sorted(self.sample)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)] / 1000 if ordered else 0
+
+    def report(self):
+        rate = self.count / self.elapsed if self.elapsed else 0
+        print(f"{self.name:<10} {self.count:>9} {rate:>12.0f} {self.percentile(0.5):>10.1f} "
+              f"{self.percentile(0.99):>10.1f} {peak_rss_mb():>9.1f}")
+
+def peak_rss_mb():
+    """returns the peak resident memory of the process in MB"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def read_dicts(csv_path):
+    with open(csv_path, newline='', encoding='utf-8') as data:
+        yield from DictReader(data)
+
+def read_rows(csv_path, columns):
+    for _, row in rows_of_csv(csv_path, columns):
+        yield row
+
+def run(rows, attachment_kb, latency, connections, send_rows, build_workers, directory):
+    csv_path = Path(directory) / 'data.csv'
+    template_path = Path(directory) / 'mail.txt'
+    write_csv(csv_path, rows)
+    write_template(template_path)
+    stages = []
+
+    with Stage('parse') as stage:
+        for _ in range(100):
+            template = stage.time(parse_template, template_path)
+    stages.append(stage)
+
+    cache = ParseCache(Path(directory) / 'cache')
+    with Stage('cached') as stage:
+        for _ in range(100):
+            stage.time(ParseCache(cache.directory).template, template_path)
+    stages.append(stage)
+
+    with Stage('read-dict') as stage:
+        iterator = read_dicts(csv_path)
+        while stage.time(next, iterator, None) is not None:
+            pass
+    stages.append(stage)
+
+    columns = sorted(template.variables)
+    with Stage('read') as stage:
+        iterator = read_rows(csv_path, columns)
+        while stage.time(next, iterator, None) is not None:
+            pass
+    stages.append(stage)
+
+    with Stage('render') as stage:
+        for row in read_rows(csv_path, columns):
+            stage.time(template.render, row)
+    stages.append(stage)
+
+    with Stage('html') as stage:
+        for row in read_rows(csv_path, columns):
+            stage.time(html_body, template.render(row)['Body'], SIGNATURE)
+    stages.append(stage)
+
+    (Path(directory) / 'dossier.pdf').write_bytes(os.urandom(attachment_kb * 1024))
+    store = AttachmentStore(directory, [('dossier.pdf', None)])
+    attachments = store.shared
+    boundary = make_boundary()
+    with Stage('build') as stage:
+        for row in read_rows(csv_path, columns):
+            stage.time(build_wire, attachments, SIGNATURE, template.render(row), boundary)
+    stages.append(stage)
+
+    if build_workers:
+        with Stage('build-par') as stage:
+            rendered = ((None, template.render(row)) for row in read_rows(csv_path, columns))
+            iterator = build_mails_parallel(rendered, store, SIGNATURE, boundary, build_workers)
+            while stage.time(next, iterator, None) is not None:
+                pass
+        stages.append(stage)
+
+    with SMTPSink(latency=latency, extensions=['PIPELINING']) as sink, \
+            SMTPPool(sink.host, sink.port, None, None, connections, use_tls=False) as pool:
+        sink.messages = _Counter()
+        wires = (build_wire(attachments, SIGNATURE, template.render(row), boundary)
+                 for row, _ in zip(read_rows(csv_path, columns), range(send_rows)))
+        with Stage('send') as stage, ThreadPoolExecutor(connections) as executor:
+            for _ in executor.map(lambda wire: stage.time(pool.send, wire), wires):
+                pass
+    stages.append(stage)
+    return stages
+
+class _Counter(list):
+    """replaces the list of the received messages of the sink so that they aren't kept in memory"""
+
+    def append(self, message):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000, help="number of lines of the csv (1000, 100000, 1000000...)")
+    parser.add_argument('--attachment-kb', type=int, default=500, help="size of the joint file in KB")
+    parser.add_argument('--latency', type=float, default=0.002, help="round trip time of the SMTP sink in seconds")
+    parser.add_argument('--connections', type=int, default=4, help="number of SMTP connections used to send")
+    parser.add_argument('--build-workers', type=int, default=0,
+                        help="number of processes of an extra parallel build stage (0 to skip it)")
+    parser.add_argument('--send-rows', type=int, default=1000, help="maximum number of Emails actually sent")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        stages = run(args.rows, args.attachment_kb, args.latency, args.connections,
+                     min(args.send_rows, args.rows), args.build_workers, directory)
+    print(f"{args.rows} rows, {args.attachment_kb} KB attachment, {args.latency * 1000:.1f} ms SMTP latency, "
+          f"{args.connections} connections")
+    print(f"{'stage':<10} {'ops':>9} {'ops/s':>12} {'p50 us':>10} {'p99 us':>10} {'peak MB':>9}")
+    for stage in stages:
+        stage.report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""measures how many bytes per second of Emails ready for the wire are produced when smtplib serializes
+every EmailMessage compared with build_wire, which only serializes the headers and the text
+
+run it from the root of the project with: python -m benchmarks.serialize"""
+
+import os
+import time
+
+from message import SharedPart, build_mail, build_wire, make_boundary
+from smtpdata import flatten
+
+MESSAGES = 50
+SIZES = [10_000, 1_000_000]
+
+def make_parts(i):
+    return {
+        'From': 'John Doe <john.doe@example.com>',
+        'To': f'contact{i}@example.com',
+        'Cc': 'Sponsoring <sponsoring@example.com>',
+        'Subject': 'My cool event 2030',
+        'Body': f'Bonjour Monsieur {i},\nbla bla bla merci à ACME bla bla bla\nmerci et à bientôt\n',
+    }
+
+def throughput(serialize):
+    """returns the bytes per second and the size of the Emails produced by 'serialize'"""
+
+    start = time.perf_counter()
+    size = sum(len(serialize(make_parts(i))) for i in range(MESSAGES))
+    return size / (time.perf_counter() - start), size // MESSAGES
+
+def main():
+    print(f"{'attachment':>10} {'message':>10} {'EmailMessage MB/s':>18} {'build_wire MB/s':>16}")
+    for size in SIZES:
+        attachment = SharedPart(os.urandom(size), 'dossier.pdf')
+        boundary = make_boundary()
+        before, message = throughput(lambda parts: flatten(build_mail([attachment], '<b>sig</b>', parts)))
+        after, _ = throughput(lambda parts: build_wire([attachment], '<b>sig</b>', parts, boundary))
+        print(f"{size:>10} {message:>10} {before / 1e6:>18.1f} {after / 1e6:>16.1f}")
+
+if __name__ == '__main__':
+    main()
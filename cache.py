@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import io
+import marshal
+import os
+import sys
+
+from template import PARSER_VERSION, Template, read_template
+
+class ParseCache:
+    """the compiled templates, keyed by the hash of the content of their file so that a modified file is always
+    parsed again, the 'size' last ones are kept in memory and, when there is a 'directory', they are also stored
+    there with marshal so that a new process doesn't parse them either, the key also holds PARSER_VERSION and
+    the python version since the marshal format can change from one version to the next"""
+
+    def __init__(self, directory=None, size=32):
+        self.directory = directory
+        self.size = size
+        self.memory = OrderedDict()
+        self.lock = Lock()
+        self.hits = self.misses = 0
+
+    def key(self, kind, data):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f'{kind}\0{PARSER_VERSION}\0{sys.implementation.cache_tag}\0'.encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, kind, path, parse, to_state, from_state):
+        """returns the object parsed from the file 'path' by 'parse' (given its bytes), from memory or from
+        the cache directory when the same content was already parsed, 'to_state' and 'from_state' turn
+        the object into values marshal can store and back"""
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        key = self.key(kind, data)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        value = self.load(key, from_state)
+        if value is None:
+            self.misses += 1
+            value = parse(data)
+            self.store(key, value, to_state)
+        else:
+            self.hits += 1
+        with self.lock:
+            self.memory[key] = value
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+        return value
+
+    def load(self, key, from_state):
+        """returns the object stored under 'key' in the cache directory or None if it isn't there or can't be read"""
+
+        if self.directory is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, f'{key}.marshal'), 'rb') as file:
+                return from_state(marshal.load(file))
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, key, value, to_state):
+        """writes 'value' in the cache directory, the file is written aside first and then moved so that
+        another process never reads half of it, the values marshal can't store are only kept in memory"""
+
+        if self.directory is None:
+            return
+        try:
+            data = marshal.dumps(to_state(value))
+        except ValueError:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{key}.marshal')
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+    def template(self, path):
+        """returns the compiled template of the file 'path', like parse_template"""
+
+        return self.get('template', path, _parse_template, Template.state, Template.from_state)
+
+def _parse_template(data):
+    return read_template(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'))
+
+CACHE = ParseCache()
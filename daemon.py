@@ -0,0 +1,202 @@
+from threading import Event, Lock
+import os
+import time
+import traceback
+
+import yaml
+
+from journal import Journal, QUEUED, SENT, FAILED
+from metrics import METRICS
+from retry import Backoff, is_connection_error, is_refused
+from sender import send_all
+
+class Spool:
+    """a folder where campaigns are queued as YAML files: a job dropped in 'new' is claimed by moving it to
+    'running' and ends in 'done' or 'failed', every job keeps its journal in 'journals' so that a job
+    interrupted by a restart of the daemon resumes where it stopped"""
+
+    FOLDERS = ('new', 'running', 'done', 'failed', 'journals')
+
+    def __init__(self, directory):
+        self.directory = directory
+        for folder in self.FOLDERS:
+            os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    def path(self, folder, name):
+        return os.path.join(self.directory, folder, name)
+
+    def recover(self):
+        """puts back in 'new' the jobs that were running when the daemon stopped"""
+
+        for name in os.listdir(os.path.join(self.directory, 'running')):
+            os.replace(self.path('running', name), self.path('new', name))
+
+    def claim(self):
+        """yields the name of every new job after moving it to 'running', the rename is atomic so a job
+        is never claimed twice"""
+
+        for name in sorted(os.listdir(os.path.join(self.directory, 'new'))):
+            if not name.endswith(('.yml', '.yaml')):
+                continue
+            try:
+                os.rename(self.path('new', name), self.path('running', name))
+            except FileNotFoundError:
+                continue
+            yield name
+
+    def finish(self, name, error=None):
+        """moves the job 'name' to 'done', or to 'failed' next to a file explaining its 'error'"""
+
+        if error is None:
+            os.replace(self.path('running', name), self.path('done', name))
+            return
+        os.replace(self.path('running', name), self.path('failed', name))
+        with open(self.path('failed', name + '.error'), 'w') as file:
+            file.write(''.join(traceback.format_exception(error)))
+
+class Job:
+    """a campaign of the spool with its config, its journal and the stream of its Emails"""
+
+    def __init__(self, name, config, journal):
+        self.name = name
+        self.config = config
+        self.journal = journal
+        self.emails = None
+        self.exhausted = False
+        self.in_flight = 0
+        self.sent = 0
+        self.error = None
+
+class Daemon:
+    """sends the campaigns queued in a Spool through one pool of connections kept open between them, the
+    Emails of the running jobs are taken in turn so that each of them gets the same share of the rate
+    allowed by 'limiter', 'emails' builds the stream of Emails of a job given its config and journal like
+    campaign_emails, the config of a job is 'config' with the 'general' section of its file on top, when the
+    server can't be used (see is_connection_error) the jobs keep running and are sent again after 'backoff'"""
+
+    def __init__(self, spool, pool, limiter, emails, config, poll=1, backoff=None):
+        self.spool = spool
+        self.pool = pool
+        self.limiter = limiter
+        self.emails = emails
+        self.config = config
+        self.poll = poll
+        self.backoff = backoff or Backoff()
+        self.jobs = []
+        self.lock = Lock()
+        self.stopped = Event()
+        self.connection_error = None
+
+    def run(self):
+        """sends the jobs of the spool as they arrive until stop is called"""
+
+        self.spool.recover()
+        attempt = 0
+        while not self.stopped.is_set():
+            self.claim()
+            if not self.jobs:
+                self.stopped.wait(self.poll)
+                continue
+            self.connection_error = None
+            send_all(self.interleave(), self.pool, self.limiter, self)
+            self.settle()
+            if self.connection_error is None:
+                attempt = 0
+                continue
+            delay = self.backoff.delay(attempt)
+            attempt += 1
+            METRICS.inc('daemon_retries_total')
+            print(f"the server can't be used: {self.connection_error}, the jobs are sent again in {delay:.1f}s")
+            self.stopped.wait(delay)
+
+    def stop(self):
+        self.stopped.set()
+
+    def claim(self):
+        """starts the new jobs of the spool, a job whose file can't be used fails right away, the recipients of a
+        job are indexed in its own file of 'journals' since the jobs run at the same time"""
+
+        for name in self.spool.claim():
+            try:
+                with open(self.spool.path('running', name)) as file:
+                    general = (yaml.safe_load(file) or {}).get('general') or {}
+                config = dict(self.config, general={**self.config['general'], 'recipients_report': None, **general})
+                if config['general'].get('recipients_index') is not None:
+                    index = self.spool.path('journals', name + '.recipients.sqlite')
+                    config['general']['recipients_index'] = os.path.abspath(index)
+                job = Job(name, config, Journal(self.spool.path('journals', name + '.sqlite')))
+                job.emails = self.emails(job.config, job.journal)
+            except Exception as e:
+                print(f"job {name} failed: {e}")
+                self.spool.finish(name, e)
+                continue
+            print(f"job {name} started")
+            METRICS.inc('jobs_started_total')
+            self.jobs.append(job)
+
+    def interleave(self):
+        """yields the ((job, identity), Email) of the running jobs taking one Email of each in turn, the new
+        jobs of the spool join every 'poll' seconds, it ends when no job has Emails left"""
+
+        last_claim = time.monotonic()
+        while not self.stopped.is_set():
+            if time.monotonic() - last_claim >= self.poll:
+                self.claim()
+                last_claim = time.monotonic()
+            active = [job for job in self.jobs if not job.exhausted and job.error is None]
+            if not active:
+                return
+            for job in active:
+                try:
+                    id, wire = next(job.emails)
+                except StopIteration:
+                    job.exhausted = True
+                    continue
+                except Exception as e:
+                    job.error = e
+                    continue
+                yield (job, id), wire
+
+    def record(self, key, state, error=None):
+        """the journal of send_all: records the state of a line in the journal of its job and counts the
+        Emails of the job that are still being sent, a failure fails the job unless it only concerns the line
+        or comes from the server, then the line is sent again with the rest of the job"""
+
+        job, id = key
+        with self.lock:
+            if state == QUEUED:
+                job.in_flight += 1
+            elif state in (SENT, FAILED):
+                job.in_flight -= 1
+                job.sent += state == SENT
+                if state == FAILED and is_connection_error(error):
+                    self.connection_error = self.connection_error or error
+                elif state == FAILED and job.error is None and not is_refused(error):
+                    job.error = error
+        job.journal.record(id, state, error)
+
+    def settle(self):
+        """ends the jobs that failed or were all sent, the others were interrupted by the failure of another
+        job or of the server and start again from their journal"""
+
+        for job in list(self.jobs):
+            if job.error is None and not job.exhausted:
+                if not self.stopped.is_set():
+                    job.emails.close()
+                    job.emails = self.emails(job.config, job.journal)
+                continue
+            self.jobs.remove(job)
+            job.emails.close()
+            job.journal.close()
+            self.spool.finish(job.name, job.error)
+            METRICS.inc('jobs_finished_total', state='failed' if job.error else 'done')
+            print(f"job {job.name} {'failed: ' + str(job.error) if job.error else 'done'}, {job.sent} Emails sent")
+
+    def close(self):
+        """closes the journals of the jobs still running, they are resumed by the next start of the daemon"""
+
+        for job in self.jobs:
+            if job.emails is not None:
+                job.emails.close()
+            job.journal.close()
+        self.jobs = []
@@ -0,0 +1,121 @@
+from itertools import repeat
+import ast
+import re
+
+PLACEHOLDER = re.compile(r'\{([^{}]*)\}')
+SENTINEL = re.compile(r'__mailer_var_\d+__')
+
+SAFE_FUNCTIONS = {
+    'str': str, 'int': int, 'float': float, 'bool': bool, 'len': len,
+    'abs': abs, 'min': min, 'max': max, 'round': round,
+}
+FORBIDDEN_ATTRIBUTES = {'format', 'format_map', 'mro'}
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.IfExp, ast.Compare, ast.Call, ast.keyword,
+    ast.Constant, ast.JoinedStr, ast.FormattedValue, ast.Name, ast.Attribute, ast.Subscript, ast.Slice,
+    ast.Tuple, ast.List, ast.expr_context, ast.boolop, ast.operator, ast.unaryop, ast.cmpop,
+)
+
+def literal(value):
+    """returns the python value written in 'value' when a placeholder is used outside of a string,
+    if it isn't a python literal the text itself is returned"""
+
+    try:
+        return ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError, AttributeError):
+        return value
+
+class _BindPlaceholders(ast.NodeTransformer):
+    """turns the sentinels that replaced the placeholders into variables of the expression"""
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, str) or not SENTINEL.search(node.value):
+            return node
+        values = []
+        position = 0
+        for match in SENTINEL.finditer(node.value):
+            if match.start() > position:
+                values.append(ast.Constant(node.value[position:match.start()]))
+            values.append(ast.FormattedValue(ast.Name(match.group(), ast.Load()), -1, None))
+            position = match.end()
+        if position < len(node.value):
+            values.append(ast.Constant(node.value[position:]))
+        return ast.JoinedStr(values)
+
+    def visit_JoinedStr(self, node):
+        self.generic_visit(node)
+        values = []
+        for value in node.values:
+            values.extend(value.values if isinstance(value, ast.JoinedStr) else [value])
+        node.values = values
+        return node
+
+    def visit_Name(self, node):
+        if SENTINEL.fullmatch(node.id):
+            return ast.Call(ast.Name('literal', ast.Load()), [node], [])
+        return node
+
+class Expression:
+    """an expression of a template compiled once to bytecode, the values of a row are given to it as
+    variables so that nothing from the csv is ever parsed as python code"""
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        sentinels = {}
+
+        def replace(match):
+            variable = match.group(1)
+            if variable not in sentinels:
+                sentinels[variable] = f'__mailer_var_{len(sentinels)}__'
+            return sentinels[variable]
+
+        try:
+            tree = ast.parse(PLACEHOLDER.sub(replace, source), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"invalid expression '{name}': {e.msg}") from None
+        tree = ast.fix_missing_locations(_BindPlaceholders().visit(tree))
+        self.bindings = {sentinel: variable for variable, sentinel in sentinels.items()}
+        self.variables = set(sentinels)
+        self._check(tree)
+        self.code = compile(tree, f'<expression {name}>', 'eval')
+        self.globals = {'__builtins__': {}, 'literal': literal, **SAFE_FUNCTIONS}
+
+    def state(self):
+        """returns the expression as plain values that marshal can store, only its source is kept"""
+
+        return self.name, self.source
+
+    @classmethod
+    def from_state(cls, state):
+        """rebuilds an expression from its state, its source is checked and compiled again since a file of
+        the cache could have been changed and code loaded from it can't be trusted"""
+
+        return cls(*state)
+
+    def _check(self, tree):
+        """raises a ValueError if the expression uses anything else than simple operations on its variables"""
+
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ValueError(f"'{type(node).__name__}' is not allowed in expression '{self.name}'")
+            if isinstance(node, ast.Name) and node.id not in self.bindings \
+                    and node.id not in SAFE_FUNCTIONS and node.id != 'literal':
+                raise ValueError(f"unknown name '{node.id}' in expression '{self.name}'")
+            if isinstance(node, ast.Attribute) and (node.attr.startswith('_') or node.attr in FORBIDDEN_ATTRIBUTES):
+                raise ValueError(f"attribute '{node.attr}' is not allowed in expression '{self.name}'")
+
+    def evaluate(self, row):
+        """returns the value of the expression for the variables of 'row', a KeyError is raised if one of
+        the placeholders is not in it"""
+
+        return eval(self.code, self.globals, {sentinel: row[name] for sentinel, name in self.bindings.items()})
+
+    def evaluate_columns(self, columns, size):
+        """returns the values of the expression for 'size' rows given the values of every variable as
+        a column, a KeyError is raised if one of the placeholders has no column"""
+
+        sentinels = list(self.bindings)
+        values = zip(*(columns[name] for name in self.bindings.values())) if sentinels else repeat((), size)
+        code, globals = self.code, self.globals
+        return [eval(code, globals, dict(zip(sentinels, row))) for row in values]
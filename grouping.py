@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from email.utils import getaddresses
+import hashlib
+
+from metrics import METRICS
+
+UNDISCLOSED = 'undisclosed-recipients:;'
+
+def content_hash(email_filled):
+    """returns the hash of all the filled parts of an Email but its To, two Emails with the same hash only
+    differ by who they are sent to"""
+
+    digest = hashlib.blake2b(digest_size=16)
+    for key in sorted(email_filled):
+        if key != 'To':
+            digest.update(key.encode() + b'\0' + email_filled[key].encode('utf-8', 'surrogatepass') + b'\0')
+    return digest.digest()
+
+class _Group:
+    __slots__ = ('ids', 'email_filled', 'recipients', 'keys')
+
+    def __init__(self, email_filled):
+        self.ids = []
+        self.email_filled = email_filled
+        self.recipients = []
+        self.keys = set()
+
+    def add(self, id, addresses):
+        self.ids.append(id)
+        for address in addresses:
+            if address.lower() not in self.keys:
+                self.keys.add(address.lower())
+                self.recipients.append(address)
+
+def group_identical(rendered, checker=None, max_recipients=100, window=1000):
+    """yields the filled templates of 'rendered' with the identity of their line, but the lines whose Email
+    only differs by its To are merged into one Email sent with a single DATA to up to 'max_recipients'
+    recipients, its To is 'undisclosed-recipients:;', its recipients are given as Bcc so that nobody sees
+    the others, but the ones already in its Cc, and its identity is the tuple of the identities of its lines, at most 'window' groups wait
+    for more lines, the oldest one is sent when a new one doesn't fit, the envelope of every line is first
+    cleaned by the RecipientChecker 'checker' if there is one"""
+
+    groups = OrderedDict()
+
+    def flush(group):
+        if len(group.ids) == 1:
+            return group.ids[0], group.email_filled
+        METRICS.inc('emails_merged_total', len(group.ids) - 1)
+        if checker is not None:
+            checker.forget(group.ids)
+        copied = {address.lower() for _, address in getaddresses([group.email_filled.get('Cc', '')])}
+        hidden = [address for address in group.recipients if address.lower() not in copied]
+        return tuple(group.ids), dict(group.email_filled, To=UNDISCLOSED, Bcc=', '.join(hidden))
+
+    for id, email_filled in rendered:
+        addresses = [address for _, address in getaddresses([email_filled['To'], email_filled.get('Cc', '')])
+                     if address]
+        if checker is not None:
+            addresses = checker.clean(id, addresses)
+        key = content_hash(email_filled)
+        group = groups.get(key)
+        if group is not None and len(group.keys | {address.lower() for address in addresses}) > max_recipients:
+            yield flush(groups.pop(key))
+            group = None
+        if group is None:
+            if len(groups) >= window:
+                yield flush(groups.popitem(last=False)[1])
+            group = groups[key] = _Group(email_filled)
+        group.add(id, addresses)
+    for group in groups.values():
+        yield flush(group)
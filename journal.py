@@ -0,0 +1,70 @@
+from threading import Lock
+import sqlite3
+import time
+
+QUEUED = 'queued'
+SENT = 'sent'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+DONE = (SENT, SKIPPED)
+
+class Journal:
+    """an append only record of the state of every line of a campaign stored in SQLite in WAL mode,
+    the states are written in batches of 'batch_size' or every 'flush_interval' seconds so that
+    journaling costs a single fsync for many Emails, every batch is fsynced when it is written so
+    that it survives a crash of the system, a restarted campaign skips the lines already sent"""
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS states "
+                                "(id TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL, error TEXT)")
+        self.sent = {id for id, in self.connection.execute("SELECT id FROM states WHERE state IN (?, ?)", DONE)}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+
+    def is_sent(self, id):
+        """returns True if the line 'id' was already sent, or skipped on purpose, by a previous run"""
+
+        return id in self.sent
+
+    def record(self, id, state, error=None):
+        """records the new state of the line 'id', or of all the lines of a tuple of identities sent as one
+        Email, it is written with the next batch"""
+
+        ids = id if isinstance(id, tuple) else (id,)
+        with self.lock:
+            now = time.time()
+            self.pending.extend((id, state, now, None if error is None else str(error)) for id in ids)
+            if state in DONE:
+                self.sent.update(ids)
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """writes all the pending states"""
+
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany("INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)", self.pending)
+            self.pending = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
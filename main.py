@@ -1,189 +1,354 @@
-from smtplib import SMTP, SMTPSenderRefused
-from email.message import EmailMessage
-from csv import DictReader
 from getpass import getpass
+from itertools import islice
 from pathlib import Path
-import yaml
+from queue import Queue, Full
+from threading import Thread, Event
+import argparse
 import time
-import random
-import re
+
+from cache import CACHE
+from ratelimit import rate_limiter_from_config
+from rows import read_rows
+from metrics import METRICS, BYTES, Reporter
+
+#the modules of the email machinery, of SMTP, asyncio, SQLite and YAML are only imported by the functions
+#that need them so that importing this module, to render templates for example, stays fast
 
 RESSOURCES_PATH = Path.cwd() / 'ressources'
 CONFIG_PATH = RESSOURCES_PATH / "config.yml"
 
 def get_config(config_path):
-    """returns the configuration file in a dict"""
+    """returns the configuration file in a dict, the compiled templates are kept in its parse_cache folder"""
+    import yaml
+
     with open(config_path) as cfg:
         config = yaml.safe_load(cfg)
+    if config['general'].get('parse_cache') is not None:
+        CACHE.directory = RESSOURCES_PATH / config['general']['parse_cache']
     return config
 
+def read_file(path, mode='r'):
+    """reads a file and outputs all it's content"""
 
-def list_variables(string):
-    """returns a list of all variables of the form '{var}' inside the string given"""
+    with open(path, mode) as file:
+        return file.read()
 
-    regex = r'\{([^{}]*)\}'
-    return set(re.findall(regex, string))
+def get_csv_data(csv_path, template, general):
+    """yields the identity and the content of every line of the csv given its path, the lines are read lazily
+    by chunks and only the columns used by the template (and the 'is_sent' one when the csv has it) are kept"""
 
-def replace_placeholders(string, variables):
-    """replaces all the variables in the string of the form '{var}' with 
-    their values given in the dictionary 'variables'"""
+    column = general.get('is_sent')
+    columns = set(template.variables)
+    if column is not None:
+        columns.add(column)
+    yield from read_rows(csv_path, sorted(columns), ignored=(column,), chunk_size=general.get('csv_chunk', 1000),
+                         optional=(column,) if column not in template.variables else ())
 
-    return string.format_map(variables)
+def is_pending(id, row, general, journal=None):
+    """returns True if the line 'id' still has to be sent, False if it is marked as sent in the 'is_sent'
+    column or recorded as sent in the journal"""
 
-def fill_variables(string, variables):
-    """replaces all the variables in the string by their values in the 'variables' dict
-    accepts that the dict contains more variables and ensures that if there is one variable in the string
-    and not in the dict then an error is thrown"""
+    column = general.get('is_sent')
+    already_sent = general.get('already_sent')
+    if column is not None and already_sent is not None and row.get(column) == already_sent:
+        return False
+    return journal is None or not journal.is_sent(id)
 
-    used_vars = list_variables(string)
-    vars = {key: value for key, value in variables.items() if key in used_vars}
-    return replace_placeholders(string, vars)
+def pending_rows(csv_data, general, journal=None):
+    """yields the identity and the content of the lines of 'csv_data' that still have to be sent"""
 
-def fill_placeholders(email_parts, variables, expressions):
-    """fills all the placeholders of the form {Placeholder} in all the email parts by their respective 
-    variables or expressions"""
+    for id, row in csv_data:
+        if is_pending(id, row, general, journal):
+            yield id, row
 
-    expr = {k: eval((fill_variables(v, variables))) for k, v in expressions.items()}
-    variables.update(expr)
-    return {key: fill_variables(value, variables) for key, value in email_parts.items()}
+def render_mails(rows, template, batch_size=1, arrow=False):
+    """lazily fills the template for every line of 'rows' and yields the filled parts with the identity of
+    their line, the lines are rendered 'batch_size' at a time (with pyarrow if 'arrow')"""
 
-def build_mail(pdf, pdf_name, signature, raw_template):
-    """builds an Email object given a pdf, a signature and a template"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, max(batch_size, 1)))
+        if not chunk:
+            return
+        start = time.perf_counter()
+        filled = template.render_rows([vars for _, vars in chunk], arrow)
+        elapsed = (time.perf_counter() - start) / len(chunk)
+        for (id, _), email_filled in zip(chunk, filled):
+            METRICS.observe('render_seconds', elapsed)
+            yield id, email_filled
 
-    msg = EmailMessage()
-    body = raw_template['Body']
+def build_mails(rendered, store, signature, boundary):
+    """lazily builds one Email per filled template of 'rendered', already serialized for the wire, and yields
+    it with the identity of its line, an Email is only built when the sender asks for it, its joint files
+    come from the AttachmentStore 'store'"""
 
-    for key, value in raw_template.items():
-        if key == "Body":
-            continue
-        msg[key] = value
-    msg.set_content(body.replace('\n', '\n\n'))
-    msg.add_attachment(pdf, maintype='application', subtype='pdf', filename=pdf_name)
-    
-    text = msg.get_body()
-    text.add_alternative(html_body(body, signature), subtype="html")
-    return msg
-
-def html_body(body, signature):
-    """builds the html body for a mail and inserts the signature at the end of the mail"""
-
-    body = body.replace('\n', '<br>' * 2)
-    html = f"""\
-        <html>
-            <head></head>
-            <body>
-                <p style="font-family: Arial, sans-serif; font-size: 15px;">
-                    {body}
-                </p>
-            </body>
-            <footer>{signature}</footer>
-        </html>
-        """
-    return html
+    from message import build_wire
 
-def read_file(path, mode='r'):
-    """reads a file and outputs all it's content"""
+    for id, email_filled in rendered:
+        with METRICS.time('build_seconds'):
+            wire = build_wire(store.attachments(email_filled), signature, email_filled, boundary)
+        METRICS.observe('message_bytes', len(wire), bounds=BYTES)
+        yield id, wire
 
-    with open(path, mode) as file:
-        return file.read()
+def prefetch(iterable, size):
+    """consumes 'iterable' in a background thread and yields its items in order, at most 'size' items
+    are built ahead of the consumer so the memory used stays bounded whatever the length of 'iterable'"""
 
-def parse_template(template_path):
-    """given the path to a template parses it to build all the sections 
-    that will be used to construct an Email, the placeholders are not filled"""
+    buffer = Queue(maxsize=max(size, 1))
+    stop = Event()
+    done = object()
 
-    email_parts = {
-        'From'          : '',
-        'To'            : '',
-        'Cc'            : '',
-        'Subject'       : '',
-        'Body'          : ''
-    }
-    current_part = None
-    expressions = {}
-    with open(template_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            line = line.strip()
-            if line.startswith('#'):
-                continue
-            if line.startswith('<Expressions>'):
-                expr = line[13:].split(';')
-                expr_name = expr[0].strip()
-                expr_value = expr[1].strip()
-                expressions[expr_name] = expr_value
-            elif line.startswith('<From>'):
-                current_part = 'From'
-                email_parts[current_part] = line[6:].strip()
-            elif line.startswith('<To>'):
-                current_part = 'To'
-                email_parts[current_part] = line[4:].strip()
-            elif line.startswith('<Cc>'):
-                current_part = 'Cc'
-                email_parts[current_part] = line[4:].strip()
-            elif line.startswith('<Subject>'):
-                current_part = 'Subject'
-                email_parts[current_part] = line[9:].strip()
-            elif line.startswith('<Body>'):
-                current_part = 'Body'
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except Full:
                 continue
-            elif current_part == 'Body':
-                email_parts[current_part] += line + '\n'
-    return email_parts, expressions
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    Thread(target=produce, daemon=True).start()
+
+    def consume():
+        try:
+            while True:
+                item, error = buffer.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    return
+                yield item
+        finally:
+            stop.set()
+
+    return consume()
+
+def campaign_emails(config, journal=None, boundary=None):
+    """returns the lazy stream of Emails of the campaign described by 'config' with the identity of their
+    line, the lines already sent according to the csv or to the journal are left out, the parts of the
+    Emails are separated by 'boundary' or by a random one"""
+
+    from message import make_boundary
+
+    boundary = boundary or make_boundary()
+    template = CACHE.template(RESSOURCES_PATH / config['general']['template'])
+    signature = read_file(RESSOURCES_PATH / config['general']['signature'])
+    store = campaign_attachments(config['general'])
+    check_attachments(RESSOURCES_PATH / config['general']['csv'], template, store, config['general'])
+    csv_data = get_csv_data(RESSOURCES_PATH / config['general']['csv'], template, config['general'])
+    general = config['general']
+    checker = recipient_checker(general)
+    if checker is None:
+        rows = pending_rows(csv_data, general, journal)
+    else:
+        #the checker sees the lines already sent too so that their addresses aren't given a mail again
+        rows = checker.filter(csv_data, template, journal, general.get('render_batch', 256),
+                              lambda id, row: is_pending(id, row, general, journal))
+    rendered = render_mails(rows, template, general.get('render_batch', 256), general.get('render_arrow', False))
+    if general.get('merge_identical'):
+        from grouping import group_identical
+        rendered = group_identical(rendered, checker, general.get('max_recipients', 100),
+                                   general.get('merge_window', 1000))
+    if general.get('build_workers'):
+        from parallel import build_mails_parallel
+        emails = build_mails_parallel(rendered, store, signature, boundary, general['build_workers'],
+                                      general.get('render_batch', 256), general.get('build_ordered', True))
+    else:
+        emails = build_mails(rendered, store, signature, boundary)
+    if checker is not None:
+        emails = checker.envelopes(emails)
+    return prefetch(emails, general.get('prefetch', 16))
+
+def campaign_attachments(general):
+    """returns the AttachmentStore of the joint files of the campaign: the pdf and the 'attachments' of the
+    config attached to every Email and the files named by the Attachments part of the template, they are
+    encoded in the 'attachment_cache' folder from which they are memory mapped when there is one and in
+    memory otherwise"""
+
+    from attachments import AttachmentStore
+
+    shared = [(general['pdf'], general.get('pdf_name'))] if general.get('pdf') else []
+    for attachment in general.get('attachments') or []:
+        if isinstance(attachment, str):
+            shared.append((attachment, None))
+        else:
+            shared.append((attachment['file'], attachment.get('name')))
+    cache = general.get('attachment_cache')
+    return AttachmentStore(RESSOURCES_PATH, shared, None if cache is None else RESSOURCES_PATH / cache,
+                           general.get('attachment_memory', 256) << 20)
+
+def check_attachments(csv_path, template, store, general):
+    """reads the whole csv once to check the files named by the Attachments part of every line before the
+    first Email is sent, a missing file or one outside of ressources stops the campaign with all of them"""
 
-def get_csv_data(csv_path):
-    """returns a list of dictionaries that contain a mapping from the category name to the value per line
-    given the path to a csv"""
+    from attachments import file_names
+    from message import ATTACHMENTS
 
-    with open(csv_path, 'r') as data:
-        reader = DictReader(data)
-        csv_data = [row for row in reader]
-    return csv_data
+    if ATTACHMENTS not in template.parts:
+        return
+    names = set()
+    rows = (row for _, row in get_csv_data(csv_path, template, general))
+    while chunk := list(islice(rows, general.get('render_batch', 256))):
+        for email_filled in template.render_rows(chunk, parts=[ATTACHMENTS]):
+            names.update(file_names(email_filled))
+    store.check(names)
+
+def recipient_checker(general):
+    """returns the RecipientChecker of the campaign or None when the recipients aren't checked"""
+
+    if not general.get('check_recipients', True):
+        return None
+    from recipients import RecipientChecker, RecipientIndex
+    index = general.get('recipients_index')
+    report = general.get('recipients_report')
+    return RecipientChecker(RecipientIndex(None if index is None else RESSOURCES_PATH / index),
+                            None if report is None else RESSOURCES_PATH / report)
+
+async def send_campaign(config, password, emails=None, journal=None):
+    """builds the emails of the campaign, unless they are given, and sends them with the asyncio transport,
+    all the SMTP sessions run in the event loop while the emails are built in a background thread"""
+
+    from aiosmtp import send_all_async
+
+    if emails is None:
+        emails = campaign_emails(config, journal)
+    limiter = rate_limiter_from_config(config)
+    return await send_all_async(emails, config['server']['host'], config['server']['port'],
+                                config['server']['sender'], password, config['server'].get('connections', 1),
+                                limiter, journal=journal, **connection_options(config))
+
+def connection_options(config):
+    """returns the options of the config about keeping the SMTP connections healthy"""
+
+    from retry import Backoff
+
+    return {
+        'max_messages': config['server'].get('max_messages_per_session'),
+        'noop_after': config['server'].get('noop_after', 30),
+        'backoff': Backoff(config['server'].get('retries', 3), config['server'].get('retry_backoff', 1)),
+    }
+
+def smtp_pool(config, password):
+    """returns the pool of connections the threads backend sends through: to the relay of the config or,
+    with 'delivery: mx', to the mail exchangers of every recipient domain"""
+
+    if config['server'].get('delivery') == 'mx':
+        from mx import mx_pool_from_config
+        return mx_pool_from_config(config['server'], **connection_options(config))
+    from sender import SMTPPool
+    return SMTPPool(config['server']['host'], config['server']['port'], config['server']['sender'], password,
+                    config['server'].get('connections', 1), **connection_options(config))
+
+def open_journal(config):
+    """opens the journal of the campaign given in the config or returns None if there isn't one"""
+
+    if config['general'].get('journal') is None:
+        return None
+    from journal import Journal
+    return Journal(RESSOURCES_PATH / config['general']['journal'])
+
+def metrics_reporter(general):
+    """returns the Reporter printing the metrics every metrics_interval seconds and writing them to the
+    metrics_file of ressources if there is one"""
+
+    metrics_file = general.get('metrics_file')
+    return Reporter(METRICS, general.get('metrics_interval', 60),
+                    None if metrics_file is None else RESSOURCES_PATH / metrics_file)
+
+def dry_run(config, path, format):
+    """builds all the emails of the campaign and writes them to 'path' instead of sending them, then
+    prints how fast it went, the boundaries of the parts are the same from one dry run to the next so that
+    only what the template changed shows up when two of them are compared"""
+
+    from message import make_boundary
+    from preview import write_preview
+
+    count, size, elapsed = write_preview(campaign_emails(config, boundary=make_boundary('dry-run')), path, format)
+    elapsed = max(elapsed, 1e-9)
+    print(f"{count} Emails written to {path} in {elapsed:.2f}s "
+          f"({count / elapsed:.0f} Emails/s, {size / elapsed / 1e6:.1f} MB/s)")
+    print(METRICS.summary())
+
+def run_daemon(config, spool):
+    """sends the campaigns queued in the folder 'spool' as they arrive until ctrl-c is pressed, the password
+    is asked once and the connections stay open between the campaigns"""
+
+    from daemon import Daemon, Spool
+
+    if config['server'].get('backend') == 'asyncio':
+        raise ValueError("the daemon is only supported by the threads backend")
+    password = None if config['server'].get('delivery') == 'mx' else getpass("password: ")
+    daemon = None
+    reporter = metrics_reporter(config['general'])
+    try:
+        with reporter, smtp_pool(config, password) as pool:
+            daemon = Daemon(Spool(spool), pool, rate_limiter_from_config(config), campaign_emails, config,
+                            config['general'].get('spool_poll', 1), connection_options(config)['backoff'])
+            print(f"waiting for campaigns in {spool}")
+            daemon.run()
+    except KeyboardInterrupt:
+        print("stopped, the running campaigns will be resumed by the next start")
+    finally:
+        if daemon is not None:
+            daemon.close()
+
+def parse_arguments():
+    from preview import WRITERS
+
+    parser = argparse.ArgumentParser(description="sends the emails of the campaign described in "
+                                                 "ressources/config.yml")
+    parser.add_argument('--dry-run', metavar='PATH',
+                        help="builds the emails and writes them to PATH instead of sending them")
+    parser.add_argument('--format', choices=sorted(WRITERS), default='eml',
+                        help="eml: one file per line of the csv in the directory PATH, maildir: a Maildir, "
+                             "mbox: a single mbox file (default: eml)")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keeps running and sends the campaigns queued as YAML files in the spool folder")
+    parser.add_argument('--spool', default=str(RESSOURCES_PATH / 'spool'),
+                        help="folder of the queued campaigns of --daemon (default: ressources/spool)")
+    return parser.parse_args()
 
 def main():
     """builds emails from a template, a signature, a csv and a joint file and sends them 
     to all the people on the CSV"""
     
+    arguments = parse_arguments()
     config = get_config(CONFIG_PATH)
-    email_parts, expressions = parse_template(RESSOURCES_PATH / config['general']['template'])
-    signature = read_file(RESSOURCES_PATH / config['general']['signature'])
-    pdf = read_file(RESSOURCES_PATH / config['general']['pdf'], mode='rb')
-    pdf_name = config['general']['pdf_name'] 
-    csv_data = get_csv_data(RESSOURCES_PATH / config['general']['csv'])
-
-    server = {'host': config['server']['host'], 'port': config['server']['port']}
-    login = {'user': config['server']['sender'], 'password': getpass("password: ")}
-    print(server)
-
-    emails = []
-    for vars in csv_data:
-        email_filled = fill_placeholders(email_parts, vars, expressions)
-        emails.append(build_mail(pdf, pdf_name, signature, email_filled))
-    
-    with SMTP(config['server']['host'], config['server']['port']) as smtp:
-        smtp.starttls()
-        smtp.login(**login)
-        i = 1
-        for msg in emails:
-            try:
-                smtp.send_message(msg)
-                print()
-                print(f"{i} Emails sent")
-                i += 1
-                mean = config['general']['time_between_mails']  
-                variance = config['general']['variance_between_mails']
-                sleep_time = random.uniform(mean - variance, mean + variance)
-                time.sleep(sleep_time)
-            except SMTPSenderRefused as e:
-                smtp.connect(**server)
-                smtp.login(**login)
-                smtp.send_message(msg)
-                print()
-                print(f"{i} Emails sent")
-                i += 1
-                mean = config['general']['time_between_mails']  
-                variance = config['general']['variance_between_mails']
-                sleep_time = random.uniform(mean - variance, mean + variance)
-                time.sleep(sleep_time)
-            except e:
-                print("an unexpected error happened", e, sep='\n')
+    if arguments.dry_run is not None:
+        dry_run(config, arguments.dry_run, arguments.format)
+        return
+    if arguments.daemon:
+        run_daemon(config, arguments.spool)
+        return
+    if config['server'].get('delivery') == 'mx' and config['server'].get('backend') == 'asyncio':
+        raise ValueError("'delivery: mx' is only supported by the threads backend")
+    password = None if config['server'].get('delivery') == 'mx' else getpass("password: ")
+    print({'host': config['server']['host'], 'port': config['server']['port']})
+
+    reporter = metrics_reporter(config['general'])
+    journal = open_journal(config)
+    try:
+        emails = campaign_emails(config, journal)
+        with reporter:
+            if config['server'].get('backend') == 'asyncio':
+                import asyncio
+                asyncio.run(send_campaign(config, password, emails, journal))
                 return
-main()
+            from sender import send_all
+            limiter = rate_limiter_from_config(config)
+            with smtp_pool(config, password) as pool:
+                send_all(emails, pool, limiter, journal)
+    finally:
+        if journal is not None:
+            journal.close()
+if __name__ == '__main__':
+    main()
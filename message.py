@@ -0,0 +1,219 @@
+from email import message_from_bytes
+from email.message import EmailMessage, MIMEPart
+from email.policy import SMTP
+from email.utils import getaddresses
+import base64
+import hashlib
+import mmap
+import os
+import random
+import sys
+
+from smtpdata import flatten, recipients, stuff_periods
+
+#the part of a filled template listing the joint files of its Email, it isn't a header
+ATTACHMENTS = 'Attachments'
+
+class SharedPart(MIMEPart):
+    """a joint file encoded in base64 only once and then attached by reference to every Email of a campaign,
+    its serialized bytes are kept in 'wire', it can't be modified after its creation so that no Email can
+    change what the others send"""
+
+    def __init__(self, data, filename, maintype='application', subtype='pdf'):
+        super().__init__()
+        self.set_content(data, maintype=maintype, subtype=subtype, disposition='attachment', filename=filename)
+        self.wire = self.as_bytes(policy=SMTP)
+        self._frozen = True
+
+    def _check_mutable(self):
+        if getattr(self, '_frozen', False):
+            raise TypeError("a shared attachment can't be modified")
+
+    def __setitem__(self, name, val):
+        self._check_mutable()
+        super().__setitem__(name, val)
+
+    def __delitem__(self, name):
+        self._check_mutable()
+        super().__delitem__(name)
+
+    def replace_header(self, _name, _value):
+        self._check_mutable()
+        super().replace_header(_name, _value)
+
+    def set_payload(self, payload, charset=None):
+        self._check_mutable()
+        super().set_payload(payload, charset)
+
+class FilePart:
+    """a joint file already encoded for the Emails in the file 'path' and memory mapped, its serialized bytes
+    in 'wire' are a view of the mapping so that they are read from the disk by the kernel when they are sent
+    instead of being kept in memory, it is sent to other processes as its path"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.wire = memoryview(self.map)
+
+    def part(self):
+        """returns the joint file as a MIMEPart, it is only loaded in memory for the rare Emails that can't
+        share its serialized bytes"""
+
+        return message_from_bytes(bytes(self.wire), _class=MIMEPart, policy=SMTP)
+
+    def __reduce__(self):
+        return FilePart, (self.path,)
+
+def encode_file(path, directory, filename, maintype='application', subtype='pdf', chunk_size=57 << 14):
+    """returns the joint file 'path' as a FilePart encoded in 'directory', the file is read through a memory
+    mapping and encoded in base64 'chunk_size' bytes at a time (a multiple of the 57 bytes of a line) so that
+    neither the file nor its encoding is ever whole in memory, the encoded file is named after the content
+    and the headers of the part and is reused by the next campaigns"""
+
+    empty = MIMEPart()
+    empty.set_content(b'', maintype=maintype, subtype=subtype, disposition='attachment', filename=filename)
+    headers = empty.as_bytes(policy=SMTP).partition(b'\r\n\r\n')[0] + b'\r\n\r\n'
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b''
+    with memoryview(data) as view:
+        digest = hashlib.sha256(headers)
+        for start in range(0, len(view), chunk_size):
+            digest.update(view[start:start + chunk_size])
+        encoded = os.path.join(directory, f'{digest.hexdigest()}.b64')
+        if not os.path.exists(encoded):
+            os.makedirs(directory, exist_ok=True)
+            temporary = f'{encoded}.{os.getpid()}.tmp'
+            with open(temporary, 'wb') as file:
+                file.write(headers)
+                for start in range(0, len(view), chunk_size):
+                    file.write(base64.encodebytes(view[start:start + chunk_size]).replace(b'\n', b'\r\n'))
+            os.replace(temporary, encoded)
+    if isinstance(data, mmap.mmap):
+        data.close()
+    return FilePart(encoded)
+
+def mime_part(attachment):
+    """returns the MIMEPart of a SharedPart or of a FilePart"""
+
+    return attachment if isinstance(attachment, MIMEPart) else attachment.part()
+
+def text_mail(signature, raw_template, boundary=None):
+    """builds an Email object with the headers and the text and html bodies given a signature and a template,
+    the text and html bodies are separated by 'boundary' if it is given and by a random one otherwise"""
+
+    msg = EmailMessage()
+    body = raw_template['Body']
+
+    for key, value in raw_template.items():
+        if key in ("Body", ATTACHMENTS):
+            continue
+        msg[key] = value
+    msg.set_content(body.replace('\n', '\n\n'))
+    msg.add_alternative(html_body(body, signature), subtype="html")
+    if boundary is not None:
+        msg.set_boundary(boundary)
+    return msg
+
+def build_mail(attachments, signature, raw_template):
+    """builds an Email object given its already encoded joint files (SharedParts or FileParts), a signature
+    and a template"""
+
+    msg = text_mail(signature, raw_template)
+    if attachments:
+        msg.make_mixed()
+    for attachment in attachments:
+        msg.attach(mime_part(attachment))
+    return msg
+
+def build_wire(attachments, signature, raw_template, boundary):
+    """builds the same Email as build_mail but directly as the bytes sent on the wire, only the headers and
+    the text of the mail are serialized, the already serialized joint files are shared with the other Emails,
+    'boundary' separates the parts (and followed by 'alt' the text and html bodies) and must be the same for
+    the whole campaign, a Bcc header only adds recipients to the envelope and isn't sent"""
+
+    msg = text_mail(signature, raw_template, boundary[:-2] + 'alt==')
+    to_addrs = recipients(msg)
+    del msg['Bcc']
+    if not attachments:
+        return WireMessage(sender(msg), to_addrs, [flatten(msg)])
+    msg.make_mixed()
+    msg.set_boundary(boundary)
+    head = msg.as_bytes(policy=SMTP)
+    delimiter = b'--' + boundary.encode('ascii')
+    closing = delimiter + b'--\r\n'
+    if head.count(delimiter) != 2 or not head.endswith(closing):
+        for attachment in attachments:
+            msg.attach(mime_part(attachment))
+        return WireMessage(sender(msg), to_addrs, [flatten(msg)])
+    buffers = [head[:-len(closing)] + delimiter + b'\r\n']
+    for attachment in attachments:
+        buffers += [attachment.wire, b'\r\n' + delimiter + b'\r\n']
+    buffers[-1] = b'\r\n' + closing
+    return WireMessage(sender(msg), to_addrs, buffers, shared=tuple(range(1, len(buffers), 2)))
+
+def make_boundary(seed=None):
+    """returns a random boundary for the parts of the Emails of a campaign, or always the same one for the
+    same 'seed' so that the Emails written by two dry runs can be compared"""
+
+    if seed is None:
+        return '=' * 15 + str(random.randrange(sys.maxsize)) + '=='
+    return '=' * 15 + str(int(hashlib.sha256(seed.encode()).hexdigest(), 16) % sys.maxsize) + '=='
+
+class WireMessage:
+    """an Email already serialized as the bytes sent after DATA, kept as a list of buffers so that the
+    joint files shared by all the Emails are written to the socket without being copied or joined,
+    'shared' are the positions of the buffers that are known to never need dot stuffing"""
+
+    __slots__ = ('sender', 'recipients', 'buffers', 'shared')
+
+    def __init__(self, sender, recipients, buffers, shared=()):
+        self.sender = sender
+        self.recipients = recipients
+        self.buffers = buffers
+        self.shared = shared
+
+    @classmethod
+    def from_message(cls, msg):
+        """serializes an EmailMessage like smtplib would"""
+
+        return cls(sender(msg), recipients(msg), [flatten(msg)])
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.buffers)
+
+    def __bytes__(self):
+        return b''.join(self.buffers)
+
+    def data(self):
+        """returns the buffers to write after the DATA command, with their leading periods doubled
+        and the final '.' line"""
+
+        buffers = [buffer if index in self.shared else stuff_periods(buffer)
+                   for index, buffer in enumerate(self.buffers)]
+        if not buffers[-1].endswith(b'\r\n'):
+            buffers.append(b'\r\n')
+        buffers.append(b'.\r\n')
+        return buffers
+
+def sender(msg):
+    """returns the address of the envelope sender of 'msg'"""
+
+    return getaddresses([msg['Sender'] or msg['From']])[0][1]
+
+def html_body(body, signature):
+    """builds the html body for a mail and inserts the signature at the end of the mail"""
+
+    body = body.replace('\n', '<br>' * 2)
+    html = f"""\
+        <html>
+            <head></head>
+            <body>
+                <p style="font-family: Arial, sans-serif; font-size: 15px;">
+                    {body}
+                </p>
+            </body>
+            <footer>{signature}</footer>
+        </html>
+        """
+    return html
@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+from threading import Lock, Thread, Event
+import bisect
+import json
+import time
+
+SECONDS = [0.0001 * 2 ** i for i in range(21)]
+BYTES = [1024 * 2 ** i for i in range(16)]
+
+class Histogram:
+    """counts observations in cumulative buckets like Prometheus, the percentiles are estimated from the
+    buckets so the memory used doesn't depend on the number of observations"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """returns the upper bound of the bucket holding the 'p' percentile"""
+
+        rank = p * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """the counters and histograms of a campaign, shared by all the threads that build and send Emails"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = Lock()
+        self.started = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, bounds=SECONDS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(bounds)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """records the duration of the block in seconds in the histogram 'name'"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name):
+        """returns the sum of the counter 'name' over all its labels"""
+
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def summary(self):
+        """returns a one line summary of where the time of the campaign goes"""
+
+        elapsed = time.monotonic() - self.started
+        sent = self.counter('emails_sent_total')
+        parts = [f"{sent} sent ({sent / elapsed:.1f}/s)", f"{self.counter('emails_failed_total')} failed",
+                 f"{self.total('smtp_reconnects_total')} reconnects", f"{self.total('smtp_retries_total')} retries"]
+        for name, label in (('render_seconds', 'render'), ('build_seconds', 'build')):
+            histogram = self.histogram(name)
+            if histogram is not None:
+                parts.append(f"{label} p50 {histogram.percentile(0.5) * 1000:.2f}ms")
+        for command in ('mail', 'rcpt', 'data'):
+            histogram = self.histogram('smtp_command_seconds', command=command)
+            if histogram is not None:
+                parts.append(f"{command} p50 {histogram.percentile(0.5) * 1000:.1f}ms "
+                             f"p99 {histogram.percentile(0.99) * 1000:.1f}ms")
+        return ', '.join(parts)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'uptime_seconds': time.monotonic() - self.started,
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                                'max': h.max, 'p50': h.percentile(0.5), 'p99': h.percentile(0.99)}
+                               for (name, labels), h in self.histograms.items()],
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """returns all the metrics in the Prometheus text exposition format"""
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                seen = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    seen += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {seen}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """writes the metrics to 'path', in the Prometheus format for a '.prom' file and in JSON otherwise"""
+
+        text = self.to_prometheus() if str(path).endswith('.prom') else self.to_json()
+        with open(path, 'w') as file:
+            file.write(text)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class Reporter:
+    """prints the summary line and dumps the metrics every 'interval' seconds until it is stopped"""
+
+    def __init__(self, metrics, interval, path=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = path
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        print(self.metrics.summary())
+        if self.path is not None:
+            self.metrics.dump(self.path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+METRICS = Metrics()
@@ -0,0 +1,162 @@
+from smtplib import SMTPException, SMTPRecipientsRefused
+from threading import Lock
+
+from message import WireMessage
+from metrics import METRICS
+from sender import PipeliningSMTP, SMTPPool
+
+try:
+    import dns.resolver
+except ImportError:
+    dns = None
+
+class DNSResolver:
+    """looks up the mail exchangers of a domain with dnspython, best preference first, a domain without
+    MX record is its own mail exchanger (RFC 5321 section 5.1)"""
+
+    def __init__(self):
+        if dns is None:
+            raise RuntimeError("delivering to the MX of every domain needs dnspython: pip install dnspython")
+
+    def __call__(self, domain):
+        try:
+            answers = dns.resolver.resolve(domain, 'MX')
+        except dns.resolver.NoAnswer:
+            return [domain]
+        except dns.resolver.NXDOMAIN:
+            raise LookupError(f"the domain {domain} doesn't exist") from None
+        hosts = [str(answer.exchange).rstrip('.') for answer in sorted(answers, key=lambda answer: answer.preference)]
+        if hosts == ['']:
+            raise LookupError(f"the domain {domain} doesn't accept mails (null MX)")
+        return hosts
+
+class StaticResolver:
+    """a resolver that takes the mail exchangers of every domain from the dict 'hosts', the '*' entry is used
+    for the domains that aren't in it, a host can be given as 'host:port'"""
+
+    def __init__(self, hosts):
+        self.hosts = {domain.lower(): [hosts] if isinstance(hosts, str) else list(hosts)
+                      for domain, hosts in hosts.items()}
+
+    def __call__(self, domain):
+        hosts = self.hosts.get(domain, self.hosts.get('*'))
+        if not hosts:
+            raise LookupError(f"no mail exchanger known for {domain}")
+        return hosts
+
+class DomainPool(SMTPPool):
+    """the connections to the mail exchangers of one domain, tried in their order of preference, STARTTLS
+    is used whenever the server offers it and there is no login, a server silent for 'timeout' seconds fails
+    the connection"""
+
+    def __init__(self, hosts, port=25, size=1, use_tls=True, ssl_context=None, timeout=60, **options):
+        super().__init__(None, port, None, None, size, use_tls, **options)
+        self.hosts = hosts
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+
+    def connect(self):
+        error = None
+        for host in self.hosts:
+            host, _, port = host.partition(':')
+            try:
+                smtp = PipeliningSMTP(host, int(port or self.port), timeout=self.timeout)
+            except OSError as e:
+                error = e
+                continue
+            try:
+                smtp.ehlo()
+                if self.use_tls and smtp.has_extn('starttls'):
+                    smtp.starttls(context=self.ssl_context)
+                    smtp.ehlo()
+            except BaseException:
+                smtp.close()
+                raise
+            return smtp
+        raise error
+
+class MXPool:
+    """delivers every Email straight to the mail exchangers of its recipient domains instead of going through
+    one relay, each domain gets its own DomainPool of reused connections whose size is the number of Emails
+    sent to it at the same time ('per_domain' or its entry in 'domain_connections'), 'size' is the number
+    of Emails sent at the same time overall, the mail exchangers are found by the 'resolver' the first time
+    a domain is seen, a mail exchanger silent for 'timeout' seconds fails the Email of its domain"""
+
+    def __init__(self, resolver, size=1, port=25, per_domain=1, domain_connections=None, use_tls=True,
+                 ssl_context=None, timeout=60, **options):
+        self.resolver = resolver
+        self.size = max(size, 1)
+        self.port = port
+        self.per_domain = per_domain
+        self.domain_connections = {domain.lower(): count for domain, count in (domain_connections or {}).items()}
+        self.use_tls = use_tls
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.options = options
+        self.pools = {}
+        self.lock = Lock()
+
+    def pool(self, domain):
+        """returns the DomainPool of 'domain', resolving its mail exchangers if it is new"""
+
+        with self.lock:
+            if domain not in self.pools:
+                try:
+                    with METRICS.time('mx_resolve_seconds'):
+                        hosts = self.resolver(domain)
+                except LookupError as e:
+                    hosts = e
+                self.pools[domain] = hosts if isinstance(hosts, LookupError) else DomainPool(
+                    hosts, self.port, self.domain_connections.get(domain, self.per_domain), self.use_tls,
+                    self.ssl_context, self.timeout, **self.options)
+            return self.pools[domain]
+
+    def send(self, wire):
+        """sends 'wire' once to every domain of its recipients, with only the recipients of that domain, the
+        recipients of a domain that can't be reached or that fails the Email (once its transient errors were
+        retried) are refused like the ones its server refuses so that the domains that accepted the Email
+        aren't sent it again, returns the refused recipients and raises SMTPRecipientsRefused if all were"""
+
+        groups = {}
+        for address in wire.recipients:
+            groups.setdefault(address.rpartition('@')[2].lower(), []).append(address)
+        refused = {}
+        for domain, addresses in groups.items():
+            pool = self.pool(domain)
+            if isinstance(pool, LookupError):
+                refused.update({address: (550, str(pool).encode()) for address in addresses})
+                continue
+            part = wire if len(groups) == 1 else WireMessage(wire.sender, addresses, wire.buffers, wire.shared)
+            try:
+                refused.update(pool.send(part) or {})
+            except SMTPRecipientsRefused as e:
+                refused.update(e.recipients)
+            except (SMTPException, OSError) as e:
+                METRICS.inc('mx_domain_failures_total')
+                message = getattr(e, 'smtp_error', None)
+                reply = (getattr(e, 'smtp_code', 421), message if isinstance(message, bytes) else str(e).encode())
+                refused.update({address: reply for address in addresses})
+        if refused and len(refused) == len(wire.recipients):
+            raise SMTPRecipientsRefused(refused)
+        return refused
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                if isinstance(pool, DomainPool):
+                    pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def mx_pool_from_config(server, **options):
+    """builds the MXPool of the 'server' section of the config, the mail exchangers are looked up in DNS unless
+    'mx_hosts' gives them"""
+
+    resolver = StaticResolver(server['mx_hosts']) if server.get('mx_hosts') else DNSResolver()
+    return MXPool(resolver, server.get('connections', 1), server.get('mx_port', 25),
+                  server.get('connections_per_domain', 1), server.get('domain_connections'),
+                  timeout=server.get('mx_timeout', 60), **options)
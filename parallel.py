@@ -0,0 +1,97 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+import os
+import time
+
+from attachments import file_names
+from message import WireMessage, build_wire
+from metrics import METRICS, BYTES
+
+_worker = {}
+
+class _NeedsParts(Exception):
+    pass
+
+class _Placeholder:
+    """stands for a joint file in the workers, they only need to know where the joint files go in an Email,
+    the rare Email that can't share the serialized joint files is built by the main process"""
+
+    wire = b''
+
+    def part(self):
+        raise _NeedsParts
+
+_PLACEHOLDER = _Placeholder()
+
+def _init_worker(shared, signature, boundary):
+    """keeps what every Email of the campaign needs in the worker process, it is sent only once, 'shared' is
+    the number of joint files attached to every Email"""
+
+    _worker.update(shared=shared, signature=signature, boundary=boundary)
+
+def _build_chunk(chunk):
+    """builds the Emails of a chunk of filled templates in a worker process, the joint files are never read
+    there, the returned buffers leave them out and only their positions are sent back, the buffers are None
+    for an Email that the main process must build"""
+
+    start = time.perf_counter()
+    built = []
+    for id, email_filled in chunk:
+        attachments = [_PLACEHOLDER] * (_worker['shared'] + len(file_names(email_filled)))
+        try:
+            wire = build_wire(attachments, _worker['signature'], email_filled, _worker['boundary'])
+        except _NeedsParts:
+            built.append((id, None, None, None, ()))
+            continue
+        buffers = [None if index in wire.shared else buffer for index, buffer in enumerate(wire.buffers)]
+        built.append((id, wire.sender, wire.recipients, buffers, wire.shared))
+    return built, time.perf_counter() - start
+
+def build_mails_parallel(rendered, store, signature, boundary, workers=None, chunk_size=64, ordered=True):
+    """builds the Emails of the filled templates of 'rendered' like build_mails but in a pool of 'workers'
+    processes (one per core by default) that each receive chunks of 'chunk_size' of them, the Emails are
+    yielded in the order of 'rendered' if 'ordered' and as soon as their chunk is built otherwise, at most
+    two chunks per worker are built ahead of the consumer, the joint files are only read and encoded by this
+    process's AttachmentStore 'store', the workers never see them"""
+
+    rendered = iter(rendered)
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                   initargs=(len(store.shared), signature, boundary))
+    try:
+        in_flight = deque()
+        chunks = {}
+
+        def submit():
+            chunk = list(islice(rendered, chunk_size))
+            if chunk:
+                future = executor.submit(_build_chunk, chunk)
+                in_flight.append(future)
+                chunks[future] = chunk
+            return bool(chunk)
+
+        for _ in range(2 * workers):
+            if not submit():
+                break
+        while in_flight:
+            if ordered:
+                future = in_flight.popleft()
+            else:
+                future = next(iter(wait(in_flight, return_when=FIRST_COMPLETED).done))
+                in_flight.remove(future)
+            built, build_seconds = future.result()
+            chunk = chunks.pop(future)
+            submit()
+            for (id, sender, recipients, buffers, shared), (_, email_filled) in zip(built, chunk):
+                METRICS.observe('build_seconds', build_seconds / len(built))
+                if buffers is None:
+                    wire = build_wire(store.attachments(email_filled), signature, email_filled, boundary)
+                else:
+                    for index, attachment in zip(shared, store.attachments(email_filled)):
+                        buffers[index] = attachment.wire
+                    wire = WireMessage(sender, recipients, buffers, shared)
+                METRICS.observe('message_bytes', len(wire), bounds=BYTES)
+                yield id, wire
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from email.utils import formatdate
+import os
+import re
+import socket
+import time
+
+FROM_LINE = re.compile(rb'^(>*From )', re.MULTILINE)
+
+class EmlWriter:
+    """writes every Email in its own '<identity>.eml' file of 'directory', the files of two runs of the
+    same csv have the same names so their directories can be compared with diff"""
+
+    def __init__(self, path):
+        self.directory = path
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, id):
+        return os.path.join(self.directory, f'{name(id)}.eml')
+
+    def write(self, id, wire):
+        with open(self.filename(id), 'wb', buffering=1 << 20) as file:
+            file.writelines(wire.buffers)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class MaildirWriter(EmlWriter):
+    """delivers every Email in the 'new' folder of the Maildir 'path' so it can be opened by a mail client,
+    each file is written in 'tmp' and then moved like the Maildir format asks"""
+
+    def __init__(self, path):
+        for folder in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+        self.directory = path
+        self.suffix = f'{int(time.time())}.{os.getpid()}.{socket.gethostname()}'
+
+    def write(self, id, wire):
+        filename = f'{name(id)}.{self.suffix}'
+        temporary = os.path.join(self.directory, 'tmp', filename)
+        with open(temporary, 'wb', buffering=1 << 20) as file:
+            file.writelines(wire.buffers)
+        os.replace(temporary, os.path.join(self.directory, 'new', filename))
+
+class MboxWriter(EmlWriter):
+    """appends all the Emails to the single mbox file 'path' through one large buffer, the lines of the
+    Emails starting with 'From ' are quoted with '>' and the line endings become '\\n' like mbox expects,
+    the last 'shared_size' joint files shared by the Emails are only quoted once"""
+
+    def __init__(self, path, buffer_size=1 << 22, shared_size=8):
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.date = formatdate(usegmt=True).encode()
+        self.shared = OrderedDict()
+        self.shared_size = shared_size
+
+    def write(self, id, wire):
+        self.file.write(b'From ' + (wire.sender or 'MAILER-DAEMON').encode() + b' ' + self.date + b'\n')
+        for index, buffer in enumerate(wire.buffers):
+            if index not in wire.shared:
+                self.file.write(quote(buffer))
+                continue
+            if buffer not in self.shared:
+                self.shared[buffer] = quote(buffer)
+                if len(self.shared) > self.shared_size:
+                    self.shared.popitem(last=False)
+            self.shared.move_to_end(buffer)
+            self.file.write(self.shared[buffer])
+        self.file.write(b'\n')
+
+    def close(self):
+        self.file.close()
+
+def name(id):
+    """returns the file name of the Email of the line 'id', an Email merging several lines is named after
+    the first one and the number of the others"""
+
+    return f'{id[0]}+{len(id) - 1}' if isinstance(id, tuple) else id
+
+def quote(buffer):
+    return FROM_LINE.sub(rb'>\1', bytes(buffer).replace(b'\r\n', b'\n'))
+
+WRITERS = {'eml': EmlWriter, 'maildir': MaildirWriter, 'mbox': MboxWriter}
+
+def write_preview(emails, path, format='eml'):
+    """writes the (identity, WireMessage) 'emails' to 'path' in the 'format' of WRITERS instead of sending them
+    and returns the number of Emails, their size in bytes and the seconds it took"""
+
+    start = time.perf_counter()
+    count = size = 0
+    with WRITERS[format](path) as writer:
+        for id, wire in emails:
+            writer.write(id, wire)
+            count += 1
+            size += len(wire)
+    return count, size, time.perf_counter() - start
@@ -0,0 +1,103 @@
+from threading import Lock
+import random
+import time
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+class TokenBucket:
+    """allows 'rate' Emails every 'period' seconds with bursts of up to 'burst' Emails, the bucket is kept
+    as the theoretical arrival time of the next Email (generic cell rate algorithm) so it never needs
+    a timer to refill"""
+
+    def __init__(self, rate, period=1, burst=1):
+        if rate <= 0 or period <= 0:
+            raise ValueError("a rate limit needs a positive rate and period")
+        self.interval = period / rate
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        self.tat = 0
+
+    def earliest(self, now):
+        """returns the earliest time at which the bucket allows one more Email"""
+
+        return max(now, self.tat - self.tolerance)
+
+    def consume(self, at):
+        """takes a token for an Email sent at the time 'at'"""
+
+        self.tat = max(self.tat, at) + self.interval
+
+class RateLimiter:
+    """token buckets for the sender and for every recipient domain, asking for a send slot reserves it
+    under a lock and returns the time to wait so that the waiting never blocks the other workers, every slot
+    but the first one is delayed by a random time of up to 'jitter' seconds"""
+
+    def __init__(self, sender_limits=(), domain_limits=(), jitter=0):
+        self.sender = [TokenBucket(**limit) for limit in sender_limits]
+        self.domain_limits = list(domain_limits)
+        self.domains = {}
+        self.jitter = jitter
+        self.started = False
+        self.lock = Lock()
+
+    def buckets(self, domains):
+        """returns the buckets that must all allow an Email sent to 'domains'"""
+
+        buckets = list(self.sender)
+        if self.domain_limits:
+            for domain in domains:
+                if domain not in self.domains:
+                    self.domains[domain] = [TokenBucket(**limit) for limit in self.domain_limits]
+                buckets.extend(self.domains[domain])
+        return buckets
+
+    def reserve(self, domains=()):
+        """reserves a send slot for an Email to the recipient 'domains' and returns how many seconds
+        are left before it"""
+
+        with self.lock:
+            now = time.monotonic()
+            buckets = self.buckets(set(domains))
+            at = max((bucket.earliest(now) for bucket in buckets), default=now)
+            if self.jitter and self.started:
+                at += random.uniform(0, self.jitter)
+            self.started = True
+            for bucket in buckets:
+                bucket.consume(at)
+        return at - now
+
+    def wait(self, domains=()):
+        """blocks until the next send slot"""
+
+        time.sleep(self.reserve(domains))
+
+    async def wait_async(self, domains=()):
+        """waits for the next send slot without blocking the event loop"""
+
+        import asyncio
+
+        await asyncio.sleep(self.reserve(domains))
+
+def parse_limit(limit):
+    """turns a limit of the config such as {'rate': 100, 'per': 'minute', 'burst': 10} into the arguments
+    of a TokenBucket, 'per' is either a number of seconds or one of PERIODS, without a 'burst' the whole
+    'rate' can be sent at once like a provider quota allows it, a 2000/day quota doesn't space the Emails
+    by 43.2s"""
+
+    period = limit.get('per', 'second')
+    period = PERIODS[period] if isinstance(period, str) else period
+    return {'rate': limit['rate'], 'period': period, 'burst': limit.get('burst', limit['rate'])}
+
+def rate_limiter_from_config(config):
+    """builds the RateLimiter of the 'rate_limits' section of the config, without it the Emails are spaced
+    by time_between_mails ± variance_between_mails seconds like they always were, the first one is sent
+    right away and the workers are spaced by at least a millisecond when the spacing can be 0"""
+
+    limits = config.get('rate_limits')
+    if limits is None:
+        mean = config['general']['time_between_mails']
+        variance = config['general']['variance_between_mails']
+        shortest = max(mean - variance, 0)
+        return RateLimiter([{'rate': 1, 'period': shortest or 0.001}], jitter=max(mean + variance - shortest, 0))
+    return RateLimiter([parse_limit(limit) for limit in limits.get('sender') or []],
+                       [parse_limit(limit) for limit in limits.get('domain') or []],
+                       limits.get('jitter', 0))
@@ -0,0 +1,191 @@
+from email.utils import getaddresses
+from itertools import islice
+import csv
+import re
+import sqlite3
+
+from journal import SKIPPED
+from metrics import METRICS
+
+LOCAL_PART = re.compile(r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*")
+DOMAIN = re.compile(r"([A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+([A-Za-z]{2,63}|xn--[A-Za-z0-9-]{1,59})")
+
+def to_ascii(address):
+    """returns 'address' without the surrounding spaces and with its domain in ASCII (IDNA), the form that
+    can be given to RCPT TO"""
+
+    local, _, domain = address.strip().rpartition('@')
+    try:
+        domain = domain.rstrip('.').encode('idna').decode('ascii')
+    except UnicodeError:
+        pass
+    return f'{local}@{domain}'
+
+def normalize(address):
+    """returns the form of 'address' used to compare it with the others, in ASCII like to_ascii and in lower
+    case like most providers treat it"""
+
+    return to_ascii(address).lower()
+
+def is_valid(address):
+    """returns True if the normalized 'address' is a syntactically valid address that a server can accept
+    in RCPT TO, it doesn't check that the mailbox exists"""
+
+    local, _, domain = address.rpartition('@')
+    return (len(address) <= 254 and 0 < len(local) <= 64 and LOCAL_PART.fullmatch(local) is not None
+            and DOMAIN.fullmatch(domain) is not None)
+
+class RecipientIndex:
+    """the set of the addresses already given a mail, kept in memory or in the SQLite file 'path' when the
+    list of recipients is too large for it, the file is opened by the first add since the lines are checked
+    in the thread that builds the Emails and a SQLite connection can only be used by the thread that opened it"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.seen = set()
+        self.connection = None
+
+    def open(self):
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("DROP TABLE IF EXISTS seen")
+        self.connection.execute("CREATE TABLE seen (address TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def add(self, address):
+        """adds the normalized 'address' to the index and returns True if it wasn't in it"""
+
+        if self.path is None:
+            if address in self.seen:
+                return False
+            self.seen.add(address)
+            return True
+        if self.connection is None:
+            self.open()
+        return self.connection.execute("INSERT OR IGNORE INTO seen VALUES (?)", (address,)).rowcount == 1
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+class RecipientChecker:
+    """checks the To and Cc addresses of every line before its Email is built, a line is dropped when none
+    of its To addresses is valid and new to the campaign, the invalid addresses and the To addresses
+    that already had a mail are removed from the envelope of the lines that are kept and every problem
+    is counted and written to the 'report' csv if one is given"""
+
+    def __init__(self, index, report=None):
+        self.index = index
+        self.excluded = {}
+        self.problems = {}
+        self.dropped = 0
+        self.report_file = None if report is None else open(report, 'w', newline='')
+        self.report = None if report is None else csv.writer(self.report_file)
+        if self.report is not None:
+            self.report.writerow(['id', 'header', 'address', 'problem'])
+
+    def problem(self, id, header, address, problem):
+        self.problems[problem] = self.problems.get(problem, 0) + 1
+        METRICS.inc('recipients_rejected_total', problem=problem)
+        if self.report is not None:
+            self.report.writerow([id, header, address, problem])
+
+    def check(self, id, to, cc):
+        """checks the filled To and Cc headers of the line 'id' and returns True if its Email must be sent"""
+
+        keep = False
+        excluded = set()
+        for header, value in (('To', to), ('Cc', cc)):
+            for _, address in getaddresses([value]) if value else []:
+                key = normalize(address)
+                if not is_valid(key):
+                    self.problem(id, header, address, 'invalid')
+                    excluded.add(key)
+                elif header == 'To' and self.index.add(key):
+                    keep = True
+                elif header == 'To':
+                    self.problem(id, header, address, 'duplicate')
+                    excluded.add(key)
+        if not keep:
+            self.dropped += 1
+            METRICS.inc('emails_skipped_total')
+        elif excluded:
+            self.excluded[id] = excluded
+        return keep
+
+    def seed(self, to):
+        """adds the valid addresses of the filled To header of a line already sent to the index"""
+
+        for _, address in getaddresses([to]) if to else []:
+            key = normalize(address)
+            if is_valid(key):
+                self.index.add(key)
+
+    def filter(self, rows, template, journal=None, batch_size=256, pending=None):
+        """yields the (identity, row) of 'rows' whose Email must be sent, their To and Cc are filled
+        'batch_size' lines at a time, the dropped lines are recorded as skipped in the journal, the lines
+        for which 'pending(id, row)' is False were sent by a previous run: they aren't yielded but their
+        To addresses are added to the index so that a resumed campaign doesn't send to them twice"""
+
+        rows = iter(rows)
+        try:
+            while True:
+                chunk = list(islice(rows, max(batch_size, 1)))
+                if not chunk:
+                    break
+                filled = template.render_rows([vars for _, vars in chunk], parts=('To', 'Cc'))
+                for (id, vars), parts in zip(chunk, filled):
+                    if pending is not None and not pending(id, vars):
+                        self.seed(parts['To'])
+                    elif self.check(id, parts['To'], parts['Cc']):
+                        yield id, vars
+                    elif journal is not None:
+                        journal.record(id, SKIPPED, 'no valid new recipient')
+            print(self.summary())
+        finally:
+            self.close()
+
+    def clean(self, id, recipients):
+        """returns the envelope 'recipients' of the Email of the line 'id' without the addresses removed
+        by check and without repeated addresses, their domain in ASCII since the envelope is sent as is"""
+
+        excluded = self.excluded.get(id, ())
+        kept = []
+        seen = set()
+        for address in recipients:
+            key = normalize(address)
+            if key not in excluded and key not in seen:
+                seen.add(key)
+                kept.append(to_ascii(address))
+        return kept
+
+    def envelope(self, id, recipients):
+        """cleans the envelope of the line 'id' like clean, once its Email is built"""
+
+        kept = self.clean(id, recipients)
+        self.excluded.pop(id, None)
+        return kept
+
+    def forget(self, ids):
+        """drops what is known about the envelopes of the lines 'ids', their recipients were already cleaned"""
+
+        for id in ids:
+            self.excluded.pop(id, None)
+
+    def envelopes(self, emails):
+        """yields the (identity, WireMessage) 'emails' with their envelope recipients cleaned by envelope"""
+
+        for id, wire in emails:
+            wire.recipients = self.envelope(id, wire.recipients)
+            yield id, wire
+
+    def summary(self):
+        problems = ', '.join(f'{count} {problem}' for problem, count in sorted(self.problems.items()))
+        return f"recipients checked: {self.dropped} lines skipped ({problems or 'no problem'})"
+
+    def close(self):
+        self.index.close()
+        if self.report_file is not None:
+            self.report_file.close()
+            self.report_file = self.report = None
@@ -0,0 +1,43 @@
+from smtplib import (SMTPAuthenticationError, SMTPConnectError, SMTPDataError, SMTPHeloError, SMTPRecipientsRefused,
+                     SMTPResponseException, SMTPSenderRefused, SMTPServerDisconnected)
+import random
+
+class Backoff:
+    """exponential backoff with full jitter: the n-th retry waits a random time in [0, base * 2**n] seconds,
+    capped at 'maximum', and there are at most 'retries' retries"""
+
+    def __init__(self, retries=3, base=1, maximum=60):
+        self.retries = retries
+        self.base = base
+        self.maximum = maximum
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.base * 2 ** attempt, self.maximum))
+
+def is_transient(error):
+    """returns True if 'error' is worth retrying later: a 4xx reply of the server or a lost connection"""
+
+    if isinstance(error, SMTPRecipientsRefused):
+        return bool(error.recipients) and all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (SMTPServerDisconnected, ConnectionError, TimeoutError))
+
+def is_closing(error):
+    """returns True if the server closes the connection after 'error' (421 service not available)"""
+
+    return isinstance(error, SMTPServerDisconnected) or getattr(error, 'smtp_code', None) == 421
+
+def is_refused(error):
+    """returns True if 'error' only concerns the Email that got it, its recipients or its content were refused,
+    so that its line fails and the campaign goes on, the other errors (lost connection, login, sender refused)
+    would fail every Email and stop it"""
+
+    return isinstance(error, (SMTPRecipientsRefused, SMTPDataError)) and not is_closing(error)
+
+def is_connection_error(error):
+    """returns True if 'error' comes from the connection to the server and not from the Email that got it: the
+    server can't be reached, closed the connection, refused the login or the sender, every Email would get it"""
+
+    return is_closing(error) or isinstance(error, (SMTPConnectError, SMTPHeloError, SMTPAuthenticationError,
+                                                   SMTPSenderRefused, ConnectionError, TimeoutError))
@@ -0,0 +1,89 @@
+from csv import reader
+from itertools import islice
+import hashlib
+
+def row_identity(columns, ignored=()):
+    """returns the function computing the identity of the values of a line of the csv whose header is
+    'columns', it doesn't depend on the order of the columns and the 'ignored' ones (like the one marking
+    a mail as sent) don't change it"""
+
+    order = sorted((key, index) for index, key in enumerate(columns) if key not in ignored)
+    keys = [(str(key).encode() + b'\0', index) for key, index in order]
+
+    def identity(values):
+        digest = hashlib.blake2b(digest_size=16)
+        for key, index in keys:
+            digest.update(key)
+            digest.update(str(values[index]).encode() + b'\0')
+        return digest.hexdigest()
+
+    return identity
+
+def row_class(columns):
+    """returns a tuple subclass holding the values of 'columns' that can be read like a dictionary,
+    a line then costs a small tuple instead of a dictionary with every column of the csv"""
+
+    index = {column: position for position, column in enumerate(columns)}
+
+    class Row(tuple):
+        __slots__ = ()
+
+        def __getitem__(self, key):
+            if isinstance(key, str):
+                return tuple.__getitem__(self, index[key])
+            return tuple.__getitem__(self, key)
+
+        def get(self, key, default=None):
+            position = index.get(key)
+            return default if position is None else tuple.__getitem__(self, position)
+
+        def keys(self):
+            return index.keys()
+
+        def items(self):
+            return zip(index, self)
+
+        def __contains__(self, key):
+            return key in index
+
+    Row.columns = tuple(columns)
+    return Row
+
+def read_chunks(csv_path, columns=None, ignored=(), chunk_size=1000, optional=()):
+    """yields the lines of the csv by lists of at most 'chunk_size' (identity, Row) pairs, only the 'columns'
+    are kept in the rows (all of them when None) while the identity is computed from every column but the
+    'ignored' ones, a ValueError is raised if one of the 'columns' isn't in the csv unless it is 'optional',
+    an optional column missing from the csv is left out of the rows"""
+
+    with open(csv_path, 'r', newline='', buffering=1 << 20) as data:
+        lines = reader(data)
+        header = next(lines, [])
+        if columns is None:
+            columns = header
+        positions = {column: position for position, column in enumerate(header)}
+        columns = [column for column in columns if column in positions or column not in optional]
+        missing = [column for column in columns if column not in positions]
+        if missing:
+            raise ValueError(f"the columns {', '.join(sorted(missing))} are not in {csv_path}")
+        projection = [positions[column] for column in columns]
+        Row = row_class(columns)
+        identity = row_identity(header, ignored)
+        width = len(header)
+
+        while True:
+            chunk = []
+            for values in islice(lines, chunk_size):
+                if not values:
+                    continue
+                if len(values) < width:
+                    values += [None] * (width - len(values))
+                chunk.append((identity(values), Row(values[position] for position in projection)))
+            if not chunk:
+                return
+            yield chunk
+
+def read_rows(csv_path, columns=None, ignored=(), chunk_size=1000, optional=()):
+    """yields the (identity, Row) pairs of all the lines of the csv, read by chunks"""
+
+    for chunk in read_chunks(csv_path, columns, ignored, chunk_size, optional):
+        yield from chunk
@@ -0,0 +1,316 @@
+from smtplib import (SMTP, SMTPDataError, SMTPException, SMTPRecipientsRefused, SMTPSenderRefused,
+                     SMTPServerDisconnected, quoteaddr)
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Lock, Semaphore, Event
+from ssl import SSLSocket
+import time
+
+from journal import QUEUED, SENT, FAILED
+from metrics import METRICS
+from retry import Backoff, is_closing, is_refused, is_transient
+from smtpdata import EOLS, domains, prepare_data
+
+class PipeliningSMTP(SMTP):
+    """an smtplib client that sends MAIL, all the RCPT and DATA in one write when the server advertises
+    PIPELINING (RFC 2920) and then reads all the replies, an Email then costs two round trips instead of
+    one per command, already serialized WireMessages are written straight to the socket by send_wire"""
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        with METRICS.time('smtp_command_seconds', command='connect'):
+            return super().connect(host, port, source_address)
+
+    def starttls(self, *args, **kwargs):
+        with METRICS.time('smtp_command_seconds', command='starttls'):
+            return super().starttls(*args, **kwargs)
+
+    def login(self, user, password, *, initial_response_ok=True):
+        with METRICS.time('smtp_command_seconds', command='auth'):
+            return super().login(user, password, initial_response_ok=initial_response_ok)
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('pipelining'):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(msg, str):
+            msg = EOLS.sub(b'\r\n', msg.encode('ascii'))
+        refused = self._open_data(from_addr, to_addrs, len(msg), mail_options, rcpt_options)
+        start = time.perf_counter()
+        self.send(prepare_data(msg))
+        return self._end_data(refused, start)
+
+    def send_wire(self, wire):
+        """sends a WireMessage, its buffers are written as they are without being joined"""
+
+        self.ehlo_or_helo_if_needed()
+        refused = self._open_data(wire.sender, wire.recipients, len(wire))
+        start = time.perf_counter()
+        write_buffers(self.sock, wire.data())
+        return self._end_data(refused, start)
+
+    def _open_data(self, from_addr, to_addrs, size, mail_options=(), rcpt_options=()):
+        """sends the envelope, pipelined if possible, and returns the refused recipients once the server
+        is ready to receive the data"""
+
+        mail_options = list(mail_options)
+        if self.has_extn('size'):
+            mail_options.append(f"size={size}")
+        commands = [_with_options(f"MAIL FROM:{quoteaddr(from_addr)}", mail_options)]
+        commands += [_with_options(f"RCPT TO:{quoteaddr(address)}", rcpt_options) for address in to_addrs]
+        commands.append("DATA")
+        names = ['mail'] + ['rcpt'] * len(to_addrs) + ['data']
+        if self.has_extn('pipelining'):
+            start = time.perf_counter()
+            self.send(''.join(command + '\r\n' for command in commands))
+            replies = []
+            for name in names:
+                replies.append(self.getreply())
+                METRICS.observe('smtp_command_seconds', time.perf_counter() - start, command=name)
+        else:
+            replies = [self._timed(names[0], commands[0])]
+            if replies[0][0] == 250:
+                replies += [self._timed('rcpt', command) for command in commands[1:-1]]
+                if any(code in (250, 251) for code, _ in replies[1:]):
+                    replies.append(self._timed('data', "DATA"))
+
+        code, resp = replies[0]
+        data_code, data_resp = replies[-1] if len(replies) == len(commands) else (None, None)
+        if code != 250:
+            self._abort(data_code)
+            raise SMTPSenderRefused(code, resp, from_addr)
+        refused = {address: reply for address, reply in zip(to_addrs, replies[1:]) if reply[0] not in (250, 251)}
+        if len(refused) == len(to_addrs):
+            self._abort(data_code)
+            raise SMTPRecipientsRefused(refused)
+        if data_code != 354:
+            self._abort(data_code)
+            raise SMTPDataError(data_code, data_resp)
+        return refused
+
+    def _timed(self, name, command):
+        with METRICS.time('smtp_command_seconds', command=name):
+            return self.docmd(command)
+
+    def _end_data(self, refused, start):
+        code, resp = self.getreply()
+        METRICS.observe('smtp_command_seconds', time.perf_counter() - start, command='data')
+        if code != 250:
+            raise SMTPDataError(code, resp)
+        return refused
+
+    def _abort(self, data_code):
+        """cancels a transaction, if the server still accepted DATA an empty message is ended first"""
+
+        if data_code == 354:
+            self.send(b'.\r\n')
+            self.getreply()
+        self.rset()
+
+def _with_options(command, options):
+    return ' '.join([command, *options])
+
+def write_buffers(sock, buffers):
+    """writes all the 'buffers' to 'sock', with a single sendmsg call when the socket supports it"""
+
+    if isinstance(sock, SSLSocket):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    views = [memoryview(buffer) for buffer in buffers if buffer]
+    while views:
+        written = sock.sendmsg(views)
+        while views and written >= len(views[0]):
+            written -= len(views.pop(0))
+        if written:
+            views[0] = views[0][written:]
+
+class ManagedConnection:
+    """an SMTP connection that is opened when it is first needed and kept healthy: after 'noop_after' seconds
+    without use it is probed with NOOP, it is opened again before reaching the 'max_messages' per session
+    allowed by the provider and after the server dropped it"""
+
+    def __init__(self, connect, max_messages=None, noop_after=30):
+        self.connect = connect
+        self.max_messages = max_messages
+        self.noop_after = noop_after
+        self.smtp = None
+        self.messages = 0
+        self.last_used = 0
+
+    def ensure(self):
+        """makes sure the connection is open and usable for one more Email"""
+
+        if self.smtp is not None and self.max_messages and self.messages >= self.max_messages:
+            METRICS.inc('smtp_reconnects_total', reason='session_limit')
+            self.reset()
+        elif self.smtp is not None and time.monotonic() - self.last_used > self.noop_after:
+            try:
+                with METRICS.time('smtp_command_seconds', command='noop'):
+                    code, _ = self.smtp.noop()
+            except (SMTPException, OSError):
+                code = None
+            if code != 250:
+                METRICS.inc('smtp_reconnects_total', reason='noop')
+                self.reset()
+        if self.smtp is None:
+            self.smtp = self.connect()
+            self.messages = 0
+
+    def send_wire(self, wire):
+        """sends a WireMessage, if the server dropped a connection that was reused the Email is sent again
+        right away on a new one"""
+
+        self.ensure()
+        reused = self.messages > 0
+        try:
+            refused = self.smtp.send_wire(wire)
+        except (SMTPException, OSError) as e:
+            if is_closing(e) or isinstance(e, OSError):
+                self.reset()
+                if reused and isinstance(e, SMTPServerDisconnected):
+                    METRICS.inc('smtp_reconnects_total', reason='dropped')
+                    return self.send_wire(wire)
+            raise
+        finally:
+            self.last_used = time.monotonic()
+        self.messages += 1
+        return refused
+
+    def reset(self):
+        """closes the connection, the next Email opens a new one"""
+
+        if self.smtp is not None:
+            _close(self.smtp)
+        self.smtp = None
+        self.messages = 0
+
+class SMTPPool:
+    """keeps up to 'size' authenticated SMTP connections to the same server, a connection is opened
+    the first time it is needed and is then reused by every Email sent through the pool, without 'use_tls'
+    or without a 'user' the connections are neither secured nor logged in, which is only meant for local servers,
+    the Emails refused with a transient error are sent again after an exponential 'backoff'"""
+
+    def __init__(self, host, port, user, password, size=1, use_tls=True, max_messages=None, noop_after=30,
+                 backoff=None):
+        self.host = host
+        self.port = port
+        self.login = {'user': user, 'password': password}
+        self.size = max(size, 1)
+        self.use_tls = use_tls
+        self.backoff = backoff or Backoff()
+        self.idle = Queue()
+        self.connections = [ManagedConnection(self.connect, max_messages, noop_after) for _ in range(self.size)]
+        for connection in self.connections:
+            self.idle.put(connection)
+
+    def connect(self):
+        """opens a new connection to the server, secures it and logs in"""
+
+        smtp = PipeliningSMTP(self.host, self.port)
+        if self.use_tls:
+            smtp.starttls()
+        if self.login['user'] is not None:
+            smtp.login(**self.login)
+        return smtp
+
+    def send(self, wire):
+        """sends the WireMessage 'wire' on one of the connections, transient failures are retried with
+        an exponential backoff"""
+
+        connection = self.idle.get()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return connection.send_wire(wire)
+                except (SMTPException, OSError) as e:
+                    if not is_transient(e) or attempt >= self.backoff.retries:
+                        raise
+                    METRICS.inc('smtp_retries_total')
+                    time.sleep(self.backoff.delay(attempt))
+                    attempt += 1
+        finally:
+            self.idle.put(connection)
+
+    def close(self):
+        """closes all the connections"""
+
+        for connection in self.connections:
+            connection.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _close(smtp):
+    """closes a connection without failing if the server already dropped it"""
+
+    try:
+        smtp.quit()
+    except (SMTPException, OSError):
+        smtp.close()
+
+def refused_text(refused):
+    """returns the recipients refused by the server for an Email that was still sent, as kept in the journal"""
+
+    return 'refused ' + ', '.join(f"{address} ({code} {message.decode('utf-8', 'replace')})"
+                                  for address, (code, message) in refused.items())
+
+def send_all(emails, pool, limiter, journal=None):
+    """sends all the WireMessages 'emails', given with the identity of their line, through the connections of 'pool'
+    as fast as 'limiter' allows, a worker reserves the send slot of an Email when it takes it and not when it is
+    queued so that an Email that waited for a free worker can't be sent right after the previous one, the state
+    of every line is recorded in the 'journal' if there is one, a line whose Email is refused fails alone while
+    the sending stops at the first other error, returns the number of Emails sent"""
+
+    def send(id, msg):
+        limiter.wait(domains(msg.recipients))
+        try:
+            refused = pool.send(msg)
+        except BaseException as e:
+            METRICS.inc('emails_failed_total')
+            if journal is not None:
+                journal.record(id, FAILED, e)
+            if not is_refused(e):
+                raise
+            print(f"the Email of the line {id} was refused", e, sep='\n')
+            return False
+        METRICS.inc('emails_sent_total')
+        if journal is not None:
+            journal.record(id, SENT, refused_text(refused) if refused else None)
+        return True
+
+    in_flight = Semaphore(pool.size * 2)
+    failed = Event()
+    lock = Lock()
+    sent = 0
+
+    def done(future):
+        nonlocal sent
+        in_flight.release()
+        error = future.exception()
+        if error is not None:
+            failed.set()
+            print("an unexpected error happened", error, sep='\n')
+            return
+        if not future.result():
+            return
+        with lock:
+            sent += 1
+            print()
+            print(f"{sent} Emails sent")
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        for id, msg in emails:
+            in_flight.acquire()
+            if failed.is_set():
+                in_flight.release()
+                break
+            if journal is not None:
+                journal.record(id, QUEUED)
+            executor.submit(send, id, msg).add_done_callback(done)
+    return sent
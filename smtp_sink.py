@@ -0,0 +1,268 @@
+from threading import Thread, Event
+import asyncio
+import base64
+
+class SMTPSinkProtocol(asyncio.Protocol):
+    """one SMTP session with a client, all the replies to the lines received in one packet are sent
+    together after 'latency' seconds to simulate the round trip to a distant server"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.transport = None
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.mail_from = None
+        self.rcpt_tos = []
+        self.data = None
+        self.auth = None
+        self.replies = []
+        self.messages = 0
+        self.upgrading = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.reply(f"220 {self.sink.hostname} ESMTP sink ready")
+        self.flush()
+
+    def data_received(self, chunk):
+        self.buffer += chunk
+        if self.upgrading:
+            return
+        while True:
+            if self.data is not None:
+                if not self.end_of_data():
+                    break
+                continue
+            end = self.buffer.find(b'\r\n')
+            if end == -1:
+                break
+            line = bytes(self.buffer[:end])
+            del self.buffer[:end + 2]
+            if self.auth is not None:
+                self.auth_line(line)
+            else:
+                self.command(line.decode('utf-8', 'replace'))
+            if self.transport is None or self.transport.is_closing():
+                return
+        self.flush()
+
+    def end_of_data(self):
+        """looks for the '.' line ending the data without scanning twice what was already received,
+        returns True once the message is complete"""
+
+        if self.sink.session_limit is not None and self.messages >= self.sink.session_limit:
+            self.reply("421 too many messages in this session")
+            self.write(b''.join(self.replies))
+            self.replies = []
+            self.transport.close()
+            return False
+        if self.buffer.startswith(b'.\r\n'):
+            end = -2
+        else:
+            end = self.buffer.find(b'\r\n.\r\n', max(self.scanned - 4, 0))
+        if end == -1:
+            self.scanned = len(self.buffer)
+            return False
+        data = bytes(self.buffer[:end + 2])
+        del self.buffer[:end + 5]
+        self.scanned = 0
+        if data.startswith(b'..'):
+            data = data[1:]
+        self.sink.messages.append((self.mail_from, self.rcpt_tos, data.replace(b'\r\n..', b'\r\n.')))
+        self.messages += 1
+        self.reset()
+        self.reply("250 OK queued")
+        return True
+
+    def reply(self, line):
+        self.replies.append(line.encode() + b'\r\n')
+
+    def flush(self):
+        """sends the pending replies, after the simulated latency if there is one"""
+
+        if not self.replies:
+            return
+        replies, self.replies = b''.join(self.replies), []
+        if self.sink.latency:
+            asyncio.get_running_loop().call_later(self.sink.latency, self.write, replies)
+        else:
+            self.write(replies)
+
+    def write(self, replies):
+        if not self.transport.is_closing():
+            self.transport.write(replies)
+
+    def command(self, line):
+        verb, _, argument = line.partition(' ')
+        verb = verb.upper()
+        if verb in ('EHLO', 'HELO'):
+            self.reset()
+            extensions = ['8BITMIME', 'SIZE 0']
+            if self.sink.ssl_context is not None and not self.transport.get_extra_info('ssl_object'):
+                extensions.append('STARTTLS')
+            if self.sink.users is not None:
+                extensions.append('AUTH PLAIN LOGIN')
+            extensions.extend(self.sink.extensions)
+            lines = [self.sink.hostname] + extensions if verb == 'EHLO' else [self.sink.hostname]
+            for line in lines[:-1]:
+                self.reply(f"250-{line}")
+            self.reply(f"250 {lines[-1]}")
+        elif verb == 'STARTTLS' and self.sink.ssl_context is not None:
+            self.reply("220 ready to start TLS")
+            self.write(b''.join(self.replies))
+            self.replies = []
+            #the ClientHello must wait for the TLS upgrade instead of being read as SMTP commands
+            self.transport.pause_reading()
+            self.upgrading = True
+            asyncio.get_running_loop().create_task(self.start_tls())
+        elif verb == 'AUTH' and self.sink.users is not None:
+            self.authenticate(argument.split())
+        elif verb == 'MAIL':
+            self.reset()
+            self.mail_from = _address(argument)
+            self.reply("250 OK")
+        elif verb == 'RCPT':
+            if self.mail_from is None:
+                self.reply("503 need MAIL before RCPT")
+            elif _address(argument) in self.sink.refused:
+                self.reply("550 no such user")
+            else:
+                self.rcpt_tos.append(_address(argument))
+                self.reply("250 OK")
+        elif verb == 'DATA':
+            if not self.rcpt_tos:
+                self.reply("503 need RCPT before DATA")
+            else:
+                self.data = []
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+        elif verb == 'RSET':
+            self.reset()
+            self.reply("250 OK")
+        elif verb == 'NOOP':
+            self.reply("250 OK")
+        elif verb == 'QUIT':
+            self.reply("221 bye")
+            self.write(b''.join(self.replies))
+            self.replies = []
+            self.transport.close()
+        else:
+            self.reply("502 command not implemented")
+
+    def authenticate(self, argument):
+        mechanism = argument[0].upper() if argument else ''
+        if mechanism == 'PLAIN' and len(argument) > 1:
+            self.check_plain(argument[1])
+        elif mechanism == 'PLAIN':
+            self.auth = ('PLAIN', [])
+            self.reply("334 ")
+        elif mechanism == 'LOGIN':
+            self.auth = ('LOGIN', [])
+            self.reply("334 VXNlcm5hbWU6")
+        else:
+            self.reply("504 unrecognized authentication type")
+
+    def auth_line(self, line):
+        mechanism, answers = self.auth
+        if mechanism == 'PLAIN':
+            self.auth = None
+            self.check_plain(line.decode())
+            return
+        answers.append(base64.b64decode(line).decode())
+        if len(answers) == 1:
+            self.reply("334 UGFzc3dvcmQ6")
+        else:
+            self.auth = None
+            self.check(*answers)
+
+    def check_plain(self, encoded):
+        _, user, password = base64.b64decode(encoded).decode().split('\0')
+        self.check(user, password)
+
+    def check(self, user, password):
+        if self.sink.users.get(user) == password:
+            self.reply("235 authentication successful")
+        else:
+            self.reply("535 authentication failed")
+
+    async def start_tls(self):
+        """upgrades the connection, the lines received before the new transport is known are kept until then
+        so that their replies are encrypted"""
+
+        loop = asyncio.get_running_loop()
+        self.transport = await loop.start_tls(self.transport, self, self.sink.ssl_context, server_side=True)
+        self.upgrading = False
+        self.data_received(b'')
+
+    def reset(self):
+        self.mail_from = None
+        self.rcpt_tos = []
+        self.data = None
+
+def _address(argument):
+    """returns the address inside the '<...>' of a MAIL FROM or RCPT TO argument"""
+
+    start = argument.find('<')
+    end = argument.find('>', start)
+    return argument[start + 1:end] if start != -1 and end != -1 else argument.partition(':')[2].strip()
+
+class SMTPSink:
+    """an SMTP server on 'host':'port' (a free port when 0) that keeps every Email it receives in
+    'messages' as (mail_from, rcpt_tos, data), 'users' maps the accepted logins to their password and
+    enables AUTH, 'ssl_context' enables STARTTLS, 'refused' lists the recipients rejected by RCPT and
+    'session_limit' is the number of Emails accepted before a connection is closed with a 421 reply"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, ssl_context=None, users=None, refused=(),
+                 extensions=(), session_limit=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.ssl_context = ssl_context
+        self.users = users
+        self.refused = set(refused)
+        self.extensions = list(extensions)
+        self.session_limit = session_limit
+        self.hostname = 'sink.localhost'
+        self.messages = []
+        self.server = None
+        self._thread = None
+        self._loop = None
+
+    async def start(self):
+        """starts listening in the running event loop"""
+
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: SMTPSinkProtocol(self), self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    def __enter__(self):
+        """runs the server in its own thread and event loop so it can be used by blocking senders"""
+
+        started = Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.stop())
+            self._loop.close()
+
+        self._thread = Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def __exit__(self, *args):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
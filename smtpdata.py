@@ -0,0 +1,43 @@
+from email.generator import BytesGenerator
+from email.utils import getaddresses
+import copy
+import io
+import re
+
+CRLF = b'\r\n'
+EOLS = re.compile(rb'(?:\r\n|\n|\r(?!\n))')
+PERIODS = re.compile(rb'(?m)^\.')
+
+def recipients(msg):
+    """returns all the addresses of the To, Cc and Bcc headers of 'msg' that aren't empty"""
+
+    fields = [field for name in ('To', 'Cc', 'Bcc') for field in msg.get_all(name, [])]
+    return [address for _, address in getaddresses(fields) if address]
+
+def domains(addresses):
+    """returns the domains of all the 'addresses'"""
+
+    return {address.rpartition('@')[2].lower() for address in addresses}
+
+def flatten(msg):
+    """returns the bytes of 'msg' as they must be sent, without its Bcc header"""
+
+    if msg['Bcc'] is not None:
+        msg = copy.copy(msg)
+        del msg['Bcc']
+    with io.BytesIO() as out:
+        BytesGenerator(out, policy=msg.policy.clone(linesep='\r\n')).flatten(msg)
+        return out.getvalue()
+
+def prepare_data(msg):
+    """returns the body of a DATA command: CRLF line endings, leading periods doubled and the final '.'"""
+
+    data = stuff_periods(EOLS.sub(CRLF, msg))
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b'.' + CRLF
+
+def stuff_periods(data):
+    """doubles the periods at the beginning of the lines so that none of them can end the DATA command"""
+
+    return PERIODS.sub(b'..', data)
@@ -0,0 +1,212 @@
+from itertools import repeat
+from string import Formatter
+
+from expressions import Expression
+
+CONVERSIONS = {None: None, 's': str, 'r': repr, 'a': ascii}
+#changes whenever parse_template or what a compiled template keeps changes, so that cached templates
+#compiled by an older version are never used
+PARSER_VERSION = 3
+
+class CompiledString:
+    """a string with placeholders of the form '{var}' split once into its literal parts and its placeholders,
+    rendering it is then a single join without parsing the string again"""
+
+    def __init__(self, string):
+        self.source = string
+        self.pieces = []
+        self.formats = []
+        for literal, name, spec, conversion in Formatter().parse(string):
+            if literal:
+                self.pieces.append(literal)
+            if name is None:
+                continue
+            self.formats.append((len(self.pieces), name, conversion, spec))
+            self.pieces.append(None)
+        self._compile()
+
+    def _compile(self):
+        self.slots = [(index, name, _converter(conversion, spec)) for index, name, conversion, spec in self.formats]
+        self.variables = {name for _, name, _ in self.slots}
+
+    def state(self):
+        """returns what the compiled string keeps as plain values that marshal can store"""
+
+        return self.source, self.pieces, self.formats
+
+    @classmethod
+    def from_state(cls, state):
+        """rebuilds a compiled string from its state without parsing it again"""
+
+        compiled = cls.__new__(cls)
+        compiled.source, compiled.pieces, compiled.formats = state
+        compiled._compile()
+        return compiled
+
+    def render(self, variables):
+        """replaces all the placeholders by their values in the 'variables' dict, the dict can contain
+        more variables but a KeyError is raised if one of the placeholders is not in it"""
+
+        pieces = self.pieces.copy()
+        for index, name, convert in self.slots:
+            pieces[index] = convert(variables[name])
+        return ''.join(pieces)
+
+    def render_columns(self, columns, size, arrow=False):
+        """renders the string for 'size' rows at once given the values of every variable as a column
+        (a sequence with one value per row) and returns the list of the rendered strings, the joins are
+        done by pyarrow if 'arrow' is True and it is installed"""
+
+        if not self.slots:
+            return [''.join(self.pieces)] * size
+        pyarrow = load_pyarrow() if arrow else None
+        if pyarrow is not None:
+            pieces = [pyarrow.array([convert(value) for value in columns[name]], pyarrow.string())
+                      if piece is None else piece
+                      for piece, (name, convert) in zip(self.pieces, self._slot_list())]
+            return pyarrow.compute.binary_join_element_wise(*pieces, '').to_pylist()
+        pieces = [repeat(piece, size) for piece in self.pieces]
+        for index, name, convert in self.slots:
+            pieces[index] = map(convert, columns[name])
+        return list(map(''.join, zip(*pieces)))
+
+    def _slot_list(self):
+        """returns the (name, converter) of every piece, (None, None) for the literal ones"""
+
+        slots = [(None, None)] * len(self.pieces)
+        for index, name, convert in self.slots:
+            slots[index] = (name, convert)
+        return slots
+
+def load_pyarrow():
+    """returns the pyarrow module or None if it isn't installed, it is only imported when it is asked for
+    since importing it takes longer than parsing a template"""
+
+    try:
+        import pyarrow
+        import pyarrow.compute
+    except ImportError:
+        return None
+    return pyarrow
+
+def _converter(conversion, spec):
+    """returns the function turning the value of a placeholder into text for its conversion and format spec"""
+
+    if conversion not in CONVERSIONS:
+        raise ValueError(f"unknown conversion '!{conversion}' in template")
+    convert = CONVERSIONS[conversion]
+    if convert is None and not spec:
+        return str
+    if convert is None:
+        return lambda value: format(value, spec)
+    if not spec:
+        return convert
+    return lambda value: format(convert(value), spec)
+
+class Template:
+    """all the parts of an Email and the expressions of a template, compiled once and rendered for every row"""
+
+    def __init__(self, email_parts, expressions):
+        self.parts = {key: CompiledString(value) for key, value in email_parts.items()}
+        self.expressions = {key: Expression(key, value) for key, value in expressions.items()}
+        self._find_variables()
+
+    def _find_variables(self):
+        used = set().union(*(part.variables for part in self.parts.values()))
+        self.variables = (used - self.expressions.keys()).union(
+            *(expr.variables for expr in self.expressions.values()))
+
+    def state(self):
+        """returns the compiled parts and expressions as plain values that marshal can store"""
+
+        return ({key: part.state() for key, part in self.parts.items()},
+                {key: expr.state() for key, expr in self.expressions.items()})
+
+    @classmethod
+    def from_state(cls, state):
+        """rebuilds a template from its state without parsing it again, only its expressions are compiled"""
+
+        parts, expressions = state
+        template = cls.__new__(cls)
+        template.parts = {key: CompiledString.from_state(part) for key, part in parts.items()}
+        template.expressions = {key: Expression.from_state(expr) for key, expr in expressions.items()}
+        template._find_variables()
+        return template
+
+    def render(self, row):
+        """fills all the placeholders in all the email parts by their respective variables from 'row'
+        or expressions and returns the filled parts"""
+
+        variables = dict(row)
+        variables.update({key: expr.evaluate(row) for key, expr in self.expressions.items()})
+        return {key: part.render(variables) for key, part in self.parts.items()}
+
+    def render_rows(self, rows, arrow=False, parts=None):
+        """fills the email parts of a whole chunk of rows at once, the rows are turned into columns so that
+        each part is rendered with a few joins over the chunk instead of once per row, returns the
+        filled parts of every row like render, or only the 'parts' given"""
+
+        size = len(rows)
+        if not size:
+            return []
+        if isinstance(rows[0], tuple) and hasattr(rows[0], 'columns'):
+            columns = dict(zip(rows[0].columns, zip(*rows)))
+        else:
+            columns = {name: [row[name] for row in rows] for name in self.variables}
+        compiled = self.parts if parts is None else {key: self.parts[key] for key in parts}
+        used = set().union(*(part.variables for part in compiled.values()))
+        variables = dict(columns)
+        variables.update({key: expr.evaluate_columns(columns, size)
+                          for key, expr in self.expressions.items() if key in used})
+        parts = {key: part.render_columns(variables, size, arrow) for key, part in compiled.items()}
+        return [dict(zip(parts, values)) for values in zip(*parts.values())]
+
+def parse_template(template_path):
+    """given the path to a template parses it to build all the sections 
+    that will be used to construct an Email and compiles them with its expressions, the placeholders are not filled"""
+
+    with open(template_path, 'r', encoding='utf-8') as file:
+        return read_template(file)
+
+def read_template(file):
+    """parses the lines of an open template like parse_template"""
+
+    email_parts = {
+        'From'          : '',
+        'To'            : '',
+        'Cc'            : '',
+        'Subject'       : '',
+        'Body'          : ''
+    }
+    current_part = None
+    expressions = {}
+    for line in file:
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if line.startswith('<Expressions>'):
+            expr = line[13:].split(';', 1)
+            expr_name = expr[0].strip()
+            expr_value = expr[1].strip()
+            expressions[expr_name] = expr_value
+        elif line.startswith('<From>'):
+            current_part = 'From'
+            email_parts[current_part] = line[6:].strip()
+        elif line.startswith('<To>'):
+            current_part = 'To'
+            email_parts[current_part] = line[4:].strip()
+        elif line.startswith('<Cc>'):
+            current_part = 'Cc'
+            email_parts[current_part] = line[4:].strip()
+        elif line.startswith('<Subject>'):
+            current_part = 'Subject'
+            email_parts[current_part] = line[9:].strip()
+        elif line.startswith('<Attachments>'):
+            current_part = 'Attachments'
+            email_parts[current_part] = line[13:].strip()
+        elif line.startswith('<Body>'):
+            current_part = 'Body'
+            continue
+        elif current_part == 'Body':
+            email_parts[current_part] += line + '\n'
+    return Template(email_parts, expressions)
@@ -0,0 +1,25 @@
+from pathlib import Path
+import ssl
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+@pytest.fixture
+def server_context():
+    """the TLS context of an SMTPSink offering STARTTLS with the self-signed certificate of the tests"""
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(Path(__file__).parent / 'keycert.pem')
+    return context
+
+@pytest.fixture
+def client_context():
+    """a TLS context for the clients that accepts the self-signed certificate of the sink"""
+
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
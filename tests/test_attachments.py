@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from attachments import AttachmentStore
+
+@pytest.fixture
+def store(tmp_path):
+    (tmp_path / 'ressources' / 'factures').mkdir(parents=True)
+    (tmp_path / 'ressources' / 'factures' / 'f1.pdf').write_bytes(b'%PDF one')
+    (tmp_path / 'secret.txt').write_text('secret')
+    return AttachmentStore(str(tmp_path / 'ressources'))
+
+def test_files_of_the_ressources(store):
+    [part] = store.attachments({'Attachments': 'factures/f1.pdf'})
+    assert part.get_filename() == 'f1.pdf'
+    store.check(['factures/f1.pdf', 'factures/../factures/f1.pdf'])
+
+@pytest.mark.parametrize('name', ['../secret.txt', 'factures/../../secret.txt'])
+def test_parent_folders_are_refused(store, name):
+    with pytest.raises(ValueError, match='outside'):
+        store.attachments({'Attachments': name})
+    with pytest.raises(ValueError, match='outside'):
+        store.check([name])
+
+def test_absolute_paths_are_refused(store, tmp_path):
+    with pytest.raises(ValueError, match='outside'):
+        store.resolve(str(tmp_path / 'ressources' / 'factures' / 'f1.pdf'))
+    with pytest.raises(ValueError, match='outside'):
+        store.check([str(tmp_path / 'secret.txt')])
+
+def test_symlinks(store, tmp_path):
+    os.symlink(tmp_path / 'secret.txt', tmp_path / 'ressources' / 'escape.pdf')
+    os.symlink(tmp_path / 'ressources' / 'factures' / 'f1.pdf', tmp_path / 'ressources' / 'facture.pdf')
+    with pytest.raises(ValueError, match='outside'):
+        store.check(['escape.pdf'])
+    [part] = store.attachments({'Attachments': 'facture.pdf'})
+    assert part.get_filename() == 'facture.pdf'
+
+def test_check_lists_every_problem(store):
+    with pytest.raises(ValueError) as error:
+        store.check(['../secret.txt', 'factures/missing.pdf', 'factures/f1.pdf'])
+    assert str(error.value).splitlines() == [f"the joint file ../secret.txt is outside of {store.directory}",
+                                             "the joint file factures/missing.pdf can't be read"]
@@ -0,0 +1,25 @@
+import marshal
+
+from cache import ParseCache
+
+TEMPLATE = '<Expressions> Title; "Dear {Name}" if {Age} > 30 else "Hi {Name}"\n<To> {Email}\n<Body>\n{Title}\n'
+
+def test_templates_are_kept_between_processes(tmp_path):
+    (tmp_path / 'mail.txt').write_text(TEMPLATE)
+    ParseCache(tmp_path / 'cache').template(tmp_path / 'mail.txt')
+    cache = ParseCache(tmp_path / 'cache')
+    template = cache.template(tmp_path / 'mail.txt')
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert template.render({'Name': 'Ann', 'Age': '42', 'Email': 'ann@example.com'})['Body'].strip() == 'Dear Ann'
+
+def test_a_changed_cache_file_is_checked_again(tmp_path):
+    (tmp_path / 'mail.txt').write_text(TEMPLATE)
+    ParseCache(tmp_path / 'cache').template(tmp_path / 'mail.txt')
+    [path] = (tmp_path / 'cache').iterdir()
+    parts, expressions = marshal.loads(path.read_bytes())
+    expressions['Title'] = ('Title', "().__class__.__base__.__subclasses__()")
+    path.write_bytes(marshal.dumps((parts, expressions)))
+    cache = ParseCache(tmp_path / 'cache')
+    template = cache.template(tmp_path / 'mail.txt')
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert template.expressions['Title'].source == '"Dear {Name}" if {Age} > 30 else "Hi {Name}"'
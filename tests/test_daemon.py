@@ -0,0 +1,57 @@
+import os
+import socket
+import threading
+import time
+
+import main
+from daemon import Daemon, Spool
+from ratelimit import RateLimiter
+from retry import Backoff
+from sender import SMTPPool
+from smtp_sink import SMTPSink
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run(daemon, until, timeout=10):
+    """runs 'daemon' in a thread until 'until()' is True or 'timeout' seconds passed"""
+
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while not until() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    daemon.stop()
+    thread.join()
+    daemon.close()
+
+def test_jobs_wait_for_the_server(tmp_path, monkeypatch):
+    (tmp_path / 'mail.txt').write_text('<From> Me <me@example.com>\n<To> {Email}\n<Subject> hello\n<Body>\nhi\n')
+    (tmp_path / 'signature.html').write_text('<b>me</b>')
+    (tmp_path / 'file.pdf').write_bytes(b'%PDF' * 100)
+    for job in ('a', 'b'):
+        (tmp_path / f'{job}.csv').write_text('Email\n' + ''.join(f'{job}{i}@example.com\n' for i in range(3)))
+    monkeypatch.setattr(main, 'RESSOURCES_PATH', tmp_path)
+    config = {'general': {'template': 'mail.txt', 'signature': 'signature.html', 'pdf': 'file.pdf',
+                          'pdf_name': 'file.pdf', 'recipients_index': 'recipients.sqlite'}}
+    spool = Spool(tmp_path / 'spool')
+    for job in ('a', 'b'):
+        (tmp_path / 'spool' / 'new' / f'{job}.yml').write_text(f'general:\n  csv: {job}.csv\n')
+    backoff = Backoff(base=0.05, maximum=0.1)
+
+    with SMTPPool('127.0.0.1', closed_port(), None, None, use_tls=False, backoff=backoff) as pool:
+        daemon = Daemon(spool, pool, RateLimiter(), main.campaign_emails, config, 0.05, backoff)
+        run(daemon, lambda: False, timeout=0.5)
+    assert sorted(os.listdir(tmp_path / 'spool' / 'running')) == ['a.yml', 'b.yml']
+    assert os.listdir(tmp_path / 'spool' / 'failed') == []
+
+    with SMTPSink() as sink, SMTPPool(sink.host, sink.port, None, None, use_tls=False) as pool:
+        daemon = Daemon(spool, pool, RateLimiter(), main.campaign_emails, config, 0.05, backoff)
+        run(daemon, lambda: len(os.listdir(tmp_path / 'spool' / 'done')) == 2)
+    assert sorted(os.listdir(tmp_path / 'spool' / 'done')) == ['a.yml', 'b.yml']
+    assert not (tmp_path / 'recipients.sqlite').exists()
+    assert (tmp_path / 'spool' / 'journals' / 'a.yml.recipients.sqlite').exists()
+    recipients = sorted(address for _, rcpt_tos, _ in sink.messages for address in rcpt_tos)
+    assert recipients == sorted(f'{job}{i}@example.com' for job in 'ab' for i in range(3))
@@ -0,0 +1,29 @@
+import csv
+import io
+
+import pytest
+
+from expressions import Expression
+from template import Template
+
+CELLS = ['O\'Brien', 'say "hi"', '"; __import__(\'os\').system(\'id\'); "', '\\', '{Age}', "' + str(1/0) + '"]
+
+def test_quotes_in_csv_cells_stay_text():
+    data = io.StringIO()
+    csv.writer(data).writerows([['Name'], *([cell] for cell in CELLS)])
+    template = Template({'Body': 'Hello {Greeting}'}, {'Greeting': '"dear {Name}" if len("{Name}") > 0 else ""'})
+    rows = list(csv.DictReader(io.StringIO(data.getvalue())))
+    assert [template.render(row)['Body'] for row in rows] == [f'Hello dear {cell}' for cell in CELLS]
+
+def test_placeholders_inside_and_outside_strings():
+    assert Expression('e', '"{Name} is {Age}"').evaluate({'Name': 'Ann', 'Age': '42'}) == 'Ann is 42'
+    assert Expression('e', '{Age} + 1').evaluate({'Age': '41'}) == 42
+    assert Expression('e', '{Name}').evaluate({'Name': "__import__('os').getcwd()"}) == "__import__('os').getcwd()"
+    assert Expression('e', '{Name}.upper()').evaluate({'Name': 'ann'}) == 'ANN'
+
+@pytest.mark.parametrize('source', ["__import__('os')", 'open("file")', '[x for x in "ab"]', 'lambda: 1',
+                                    '(x := 1)', '{Name}.__class__', '().__class__.__base__', '"{}".format(1)',
+                                    '"{x}".format_map({})', 'int.mro()', 'eval("1")', '(1).__add__(2)'])
+def test_denied_nodes_and_attributes(source):
+    with pytest.raises(ValueError):
+        Expression('e', source)
@@ -0,0 +1,10 @@
+from grouping import UNDISCLOSED, group_identical
+
+def test_cc_addresses_are_not_repeated_in_bcc():
+    rendered = [(i, {'To': f'user{i}@example.com', 'Cc': 'Sponsoring <sponsoring@gmail.com>', 'Body': 'hi'})
+                for i in range(3)]
+    [(ids, email_filled)] = group_identical(rendered)
+    assert ids == (0, 1, 2)
+    assert email_filled['To'] == UNDISCLOSED
+    assert email_filled['Cc'] == 'Sponsoring <sponsoring@gmail.com>'
+    assert email_filled['Bcc'] == 'user0@example.com, user1@example.com, user2@example.com'
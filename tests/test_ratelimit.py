@@ -0,0 +1,18 @@
+from ratelimit import rate_limiter_from_config
+
+def test_quotas_allow_their_bursts():
+    limiter = rate_limiter_from_config({'rate_limits': {'sender': [{'rate': 100, 'per': 'minute', 'burst': 10},
+                                                                   {'rate': 2000, 'per': 'day'}]}})
+    delays = [limiter.reserve() for _ in range(12)]
+    assert delays[:10] == [0] * 10
+    assert 0.5 < delays[10] <= 0.6 and 1.1 < delays[11] <= 1.2
+
+def test_time_between_mails():
+    limiter = rate_limiter_from_config({'general': {'time_between_mails': 10, 'variance_between_mails': 2}})
+    first, second = limiter.reserve(), limiter.reserve()
+    assert first == 0 and 7.9 < second <= 12
+
+def test_time_between_mails_spaces_the_workers():
+    limiter = rate_limiter_from_config({'general': {'time_between_mails': 0, 'variance_between_mails': 0}})
+    delays = [limiter.reserve() for _ in range(3)]
+    assert delays[0] == 0 and 0 < delays[1] < delays[2]
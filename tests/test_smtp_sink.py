@@ -0,0 +1,119 @@
+from itertools import islice
+from smtplib import SMTPRecipientsRefused
+import asyncio
+import socket
+
+import pytest
+
+import main
+from aiosmtp import open_session, send_all_async
+from journal import Journal
+from message import WireMessage
+from mx import MXPool, StaticResolver
+from ratelimit import RateLimiter
+from retry import Backoff
+from sender import SMTPPool, send_all
+from smtp_sink import SMTPSink
+
+def wire(recipients, subject='hello'):
+    return WireMessage('me@example.com', recipients, [f'Subject: {subject}\r\n\r\nhi\r\n.dot\r\n'.encode()])
+
+def states(journal):
+    journal.flush()
+    return dict(journal.connection.execute("SELECT id, state FROM states"))
+
+def test_send_all_delivers_every_email(tmp_path):
+    journal = Journal(tmp_path / 'journal.sqlite')
+    emails = ((f'line{i}', wire([f'user{i}@example.com'], i)) for i in range(10))
+    with SMTPSink(extensions=['PIPELINING']) as sink, \
+            SMTPPool(sink.host, sink.port, None, None, 2, use_tls=False) as pool:
+        assert send_all(emails, pool, RateLimiter(), journal) == 10
+    assert sorted(rcpt_tos for _, rcpt_tos, _ in sink.messages) == sorted([[f'user{i}@example.com'] for i in range(10)])
+    assert all(data.endswith(b'\r\n\r\nhi\r\n.dot\r\n') for _, _, data in sink.messages)
+    assert set(states(journal).values()) == {'sent'}
+
+def test_starttls_and_auth(server_context, client_context):
+    async def run():
+        async with SMTPSink(ssl_context=server_context, users={'user': 'secret'}) as sink:
+            for _ in range(20):
+                smtp = await open_session(sink.host, sink.port, 'user', 'secret', True, client_context)
+                await smtp.quit()
+            emails = ((i, wire(['someone@example.com'], i)) for i in range(5))
+            sent = await send_all_async(emails, sink.host, sink.port, 'user', 'secret', 2, use_tls=True,
+                                        ssl_context=client_context)
+            return sent, len(sink.messages)
+
+    assert asyncio.run(run()) == (5, 5)
+
+def test_starttls_to_mail_exchangers(server_context, client_context):
+    with SMTPSink(ssl_context=server_context) as sink:
+        resolver = StaticResolver({'*': f'{sink.host}:{sink.port}'})
+        with MXPool(resolver, size=2, ssl_context=client_context) as pool:
+            assert pool.send(wire(['a@one.example', 'b@two.example'])) == {}
+    assert sorted(rcpt_tos for _, rcpt_tos, _ in sink.messages) == [['a@one.example'], ['b@two.example']]
+
+def test_silent_mail_exchangers_time_out():
+    with socket.socket() as silent, SMTPSink() as sink:
+        silent.bind(('127.0.0.1', 0))
+        silent.listen()
+        resolver = StaticResolver({'silent.example': f'127.0.0.1:{silent.getsockname()[1]}',
+                                   '*': f'{sink.host}:{sink.port}'})
+        with MXPool(resolver, timeout=0.2, backoff=Backoff(retries=0)) as pool:
+            refused = pool.send(wire(['a@silent.example', 'b@example.com']))
+    assert list(refused) == ['a@silent.example']
+    assert [rcpt_tos for _, rcpt_tos, _ in sink.messages] == [['b@example.com']]
+
+def test_refused_recipients():
+    with SMTPSink(refused=['nobody@example.com']) as sink, \
+            SMTPPool(sink.host, sink.port, None, None, use_tls=False) as pool:
+        refused = pool.send(wire(['someone@example.com', 'nobody@example.com']))
+        assert refused == {'nobody@example.com': (550, b'no such user')}
+        with pytest.raises(SMTPRecipientsRefused):
+            pool.send(wire(['nobody@example.com']))
+    assert [rcpt_tos for _, rcpt_tos, _ in sink.messages] == [['someone@example.com']]
+
+def campaign(tmp_path, monkeypatch, addresses):
+    """writes a campaign sending a mail to each of 'addresses' in 'tmp_path' and returns its config"""
+
+    (tmp_path / 'mail.txt').write_text('<From> Me <me@example.com>\n<To> {Email}\n<Subject> hello\n<Body>\nhi {Name}\n')
+    (tmp_path / 'signature.html').write_text('<b>me</b>')
+    (tmp_path / 'file.pdf').write_bytes(b'%PDF' * 100)
+    (tmp_path / 'data.csv').write_text('Email,Name\n' + ''.join(f'{address},N{i}\n' for i, address in enumerate(addresses)),
+                                       encoding='utf-8')
+    monkeypatch.setattr(main, 'RESSOURCES_PATH', tmp_path)
+    return {'general': {'template': 'mail.txt', 'signature': 'signature.html', 'pdf': 'file.pdf',
+                        'pdf_name': 'file.pdf', 'csv': 'data.csv'}}
+
+def test_resume_sends_only_the_lines_left(tmp_path, monkeypatch):
+    config = campaign(tmp_path, monkeypatch, [f'user{i}@example.com' for i in range(6)])
+    journal = Journal(tmp_path / 'journal.sqlite')
+    with SMTPSink() as sink, SMTPPool(sink.host, sink.port, None, None, use_tls=False) as pool:
+        emails = main.campaign_emails(config, journal)
+        assert send_all(islice(emails, 2), pool, RateLimiter(), journal) == 2
+        emails.close()
+        assert send_all(main.campaign_emails(config, journal), pool, RateLimiter(), journal) == 4
+    recipients = [address for _, rcpt_tos, _ in sink.messages for address in rcpt_tos]
+    assert sorted(recipients) == [f'user{i}@example.com' for i in range(6)]
+    assert list(states(journal).values()).count('sent') == 6
+
+def test_a_refused_line_fails_alone(tmp_path):
+    journal = Journal(tmp_path / 'journal.sqlite')
+    emails = [(f'line{i}', wire(['nobody@example.com' if i == 1 else f'user{i}@example.com'], i)) for i in range(4)]
+    with SMTPSink(refused=['nobody@example.com']) as sink, \
+            SMTPPool(sink.host, sink.port, None, None, use_tls=False) as pool:
+        assert send_all(iter(emails), pool, RateLimiter(), journal) == 3
+    assert states(journal) == {'line0': 'sent', 'line1': 'failed', 'line2': 'sent', 'line3': 'sent'}
+
+    async def run():
+        async with SMTPSink(refused=['nobody@example.com']) as sink:
+            return await send_all_async(iter(emails), sink.host, sink.port, None, None, 1, use_tls=False)
+
+    assert asyncio.run(run()) == 3
+
+def test_unicode_domains_are_sent_in_ascii(tmp_path, monkeypatch):
+    config = campaign(tmp_path, monkeypatch, ['user0@example.com', 'user1@exämple.com', 'üser2@example.com'])
+    journal = Journal(tmp_path / 'journal.sqlite')
+    with SMTPSink() as sink, SMTPPool(sink.host, sink.port, None, None, use_tls=False) as pool:
+        assert send_all(main.campaign_emails(config, journal), pool, RateLimiter(), journal) == 2
+    assert sorted(rcpt_tos for _, rcpt_tos, _ in sink.messages) == [['user0@example.com'], ['user1@xn--exmple-cua.com']]
+    assert sorted(states(journal).values()) == ['sent', 'sent', 'skipped']